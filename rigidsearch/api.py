@@ -1,34 +1,205 @@
 import shutil
 import os
+import time
+import hashlib
+import tempfile
 from flask import Blueprint, jsonify, request, current_app, abort, json, \
-     Response
+     Response, url_for, send_from_directory
 from werkzeug.security import safe_str_cmp
 
 from rigidsearch.search import get_index, put_index, index_tree, \
-     get_index_path
-from rigidsearch.utils import cors, release_file
+     get_index_path, get_index_version, get_processing_cache, \
+     resolve_shard, parse_sections, search_sections, get_combined_version
+from rigidsearch.jobs import get_job_manager
+from rigidsearch.warmup import get_warmer
+from rigidsearch.querylog import get_query_log
+from rigidsearch.profiling import get_profiler
+from rigidsearch.utils import cors, release_file, dump_json, compress, \
+     get_supported_encodings
 
 
 bp = Blueprint('api', __name__, url_prefix='/api')
 
 
-@bp.route('/search')
-@cors()
+def make_search_etag(version, args):
+    h = hashlib.sha1()
+    h.update(version)
+    for key, value in sorted(args.items(multi=True)):
+        h.update('\x00%s=%s' % (key.encode('utf-8'), value.encode('utf-8')))
+    return h.hexdigest()
+
+
+def add_cache_headers(rv, live_path, version, etag):
+    max_age = int(current_app.config['SEARCH_CACHE_MAX_AGE'])
+    # the etag is weak as the same result is sent with different
+    # content encodings.
+    rv.set_etag(etag, weak=True)
+    rv.headers['X-Rigidsearch-Index-Version'] = version
+    if max_age > 0:
+        rv.cache_control.public = True
+        rv.cache_control.max_age = max_age
+    else:
+        rv.cache_control.no_cache = True
+    try:
+        rv.last_modified = os.path.getmtime(os.path.join(live_path, 'cur'))
+    except OSError:
+        pass
+    return rv
+
+
+@bp.route('/search', methods=['GET', 'OPTIONS'])
+@cors(expose_headers=['ETag', 'X-Rigidsearch-Index-Version'])
 def search():
+    start = time.time()
+    index_path = get_index_path()
+    sections = parse_sections(request.args.getlist('section'))
+    federated = sections is None or len(sections) > 1
+    if federated:
+        live_path = index_path
+    else:
+        live_path = resolve_shard(index_path, sections[0])
+    if get_index_version(live_path) is None:
+        # there is no index yet, this creates an empty one
+        get_index(index_path)
+    if federated:
+        version = get_combined_version(index_path)
+    else:
+        version = get_index_version(live_path)
+
+    # profiling requests must be admin authenticated and always run the
+    # search, they bypass the caches.
+    force_profile = request.args.get('profile') == '1'
+    if force_profile and not is_admin_request():
+        abort(403)
+
+    if not federated:
+        get_warmer().record_query(request.args.get('q'), sections[0])
+
+    etag = make_search_etag(version, request.args)
+    if not force_profile and request.if_none_match.contains_weak(etag):
+        return add_cache_headers(Response(status=304), live_path, version,
+                                 etag)
+
+    # responses are fully determined by the etag, so the serialized and
+    # compressed bodies can be reused until the index changes.
+    cache = current_app.extensions['rigidsearch_responses']
+    encoding = request.accept_encodings.best_match(get_supported_encodings())
+    body = None
+    if not force_profile:
+        body = cache.get((etag, encoding))
+    cached = body is not None
+    truncated = False
+    if body is None:
+        data = None
+        if not force_profile:
+            data = cache.get((etag, None))
+        cached = data is not None
+        if data is None:
+            result = run_search(index_path, sections,
+                                force_profile=force_profile)
+            data = dump_json(result)
+            # results cut short by the limits, like plain excerpts after
+            # the time ran out, depend on the load of the server, they
+            # must not be reused.
+            truncated = result.get('truncated', False)
+        cacheable = not force_profile and not truncated
+        if cacheable:
+            cache.set((etag, None), data)
+        if len(data) < int(current_app.config['SEARCH_COMPRESS_MIN_SIZE']):
+            encoding = None
+            body = data
+        else:
+            body = compress(data, encoding)
+            if cacheable:
+                cache.set((etag, encoding), body)
+
+    rv = Response(body, mimetype='application/json')
+    if encoding is not None:
+        rv.headers['Content-Encoding'] = encoding
+    rv.vary.add('Accept-Encoding')
+
+    query_log = get_query_log()
+    if query_log is not None and query_log.should_sample():
+        query_log.record(request.args, time.time() - start, cached=cached,
+                         truncated=truncated)
+
+    if force_profile or truncated:
+        rv.headers['X-Rigidsearch-Index-Version'] = version
+        rv.cache_control.no_store = True
+        return rv
+    return add_cache_headers(rv, live_path, version, etag)
+
+
+def clamp_arg(key, maximum, default=None):
+    value = request.args.get(key, type=int, default=default)
+    if value is not None:
+        value = max(1, min(value, maximum))
+    return value
+
+
+def get_search_limits():
+    """Returns the time limit and the maximum number of term expansions
+    for a search.  A value of zero disables a limit.
+    """
+    time_limit = float(current_app.config['SEARCH_TIME_LIMIT'])
+    max_expansions = int(current_app.config['SEARCH_MAX_TERM_EXPANSIONS'])
+    return time_limit or None, max_expansions or None
+
+
+def run_search(index_path, sections, force_profile=False):
+    config = current_app.config
     q = request.args.get('q') or u''
-    page = request.args.get('page', type=int, default=1)
-    per_page = request.args.get('per_page', type=int, default=20)
+    page = max(1, request.args.get('page', type=int, default=1))
+    per_page = clamp_arg('per_page', int(config['SEARCH_MAX_PER_PAGE']),
+                         default=20)
     excerpt_fragmenter = request.args.get('excerpt_fragmenter')
-    excerpt_maxchars = request.args.get('excerpt_maxchars', type=int)
-    excerpt_surround = request.args.get('excerpt_surround', type=int)
-    section = request.args.get('section') or 'generic'
+    excerpt_maxchars = clamp_arg(
+        'excerpt_maxchars', int(config['SEARCH_MAX_EXCERPT_CHARS']))
+    excerpt_surround = clamp_arg(
+        'excerpt_surround', int(config['SEARCH_MAX_EXCERPT_SURROUND']))
+    time_limit, max_expansions = get_search_limits()
 
-    index_path = get_index_path()
-    return jsonify(get_index(index_path).search(
-        q, section, page=page, per_page=per_page,
-        excerpt_fragmenter=excerpt_fragmenter,
-        excerpt_maxchars=excerpt_maxchars,
-        excerpt_surround=excerpt_surround))
+    def _search():
+        return search_sections(
+            index_path, q, sections, page=page, per_page=per_page,
+            excerpt_fragmenter=excerpt_fragmenter,
+            excerpt_maxchars=excerpt_maxchars,
+            excerpt_surround=excerpt_surround,
+            time_limit=time_limit, max_expansions=max_expansions)
+
+    profiler = get_profiler()
+    if profiler is None or \
+       (not force_profile and profiler.threshold is None):
+        return _search()
+    with profiler.profile('search-%s' % q, deterministic=force_profile):
+        return _search()
+
+
+def is_admin_request():
+    # the secret is taken from a header so it does not end up in the
+    # query strings of access logs.
+    return safe_str_cmp(request.headers.get('X-Rigidsearch-Secret', ''),
+                        current_app.config['SEARCH_INDEX_SECRET'])
+
+
+@bp.route('/profiles')
+def list_profiles():
+    profiler = get_profiler()
+    if profiler is None:
+        abort(404)
+    if not is_admin_request():
+        abort(403)
+    return jsonify(profiles=profiler.list_profiles())
+
+
+@bp.route('/profiles/<filename>')
+def download_profile(filename):
+    profiler = get_profiler()
+    if profiler is None:
+        abort(404)
+    if not is_admin_request():
+        abort(403)
+    return send_from_directory(profiler.path, filename, as_attachment=True)
 
 
 @bp.route('/index', methods=['PUT'])
@@ -37,7 +208,8 @@ def update_index():
                         current_app.config['SEARCH_INDEX_SECRET']):
         abort(403)
     index_path = get_index_path()
-    put_index(index_path, request.files['archive'])
+    put_index(index_path, request.files['archive'],
+              warmup=get_warmer().warm)
     return jsonify(okay=True)
 
 
@@ -48,23 +220,78 @@ def process_zip_for_index():
         abort(403)
 
     index_path = get_index_path()
+    cache = get_processing_cache(index_path)
+    warmup = get_warmer().warm
 
-    config = json.load(request.files['config'])
+    config_data = request.files['config'].read()
+    config = json.loads(config_data)
 
-    archive = release_file(request, 'archive')
+    # The upload only lives as long as the request, so we spool it to a
+    # temporary file the build can pick up later.  While doing that we
+    # hash it so that repeated uploads of the same build are folded into
+    # the job that is already queued or running.
+    h = hashlib.sha1()
+    h.update(config_data)
+    fd, archive_filename = tempfile.mkstemp(suffix='.zip')
+    with os.fdopen(fd, 'wb') as f:
+        archive = release_file(request, 'archive')
+        while 1:
+            chunk = archive.read(16384)
+            if not chunk:
+                break
+            h.update(chunk)
+            f.write(chunk)
 
-    try:
-        shutil.rmtree(index_path)
-    except (OSError, IOError):
-        pass
+    def build(job):
+        try:
+            for event in index_tree(config, from_zip=archive_filename,
+                                    index_path=index_path, copy=False,
+                                    cache=cache, warmup=warmup):
+                job.handle_event(event)
+        finally:
+            try:
+                os.remove(archive_filename)
+            except OSError:
+                pass
+
+    job, created = get_job_manager().submit(h.hexdigest(), build)
+    if not created:
+        os.remove(archive_filename)
+
+    rv = jsonify(job.to_dict())
+    rv.status_code = 202
+    rv.headers['Location'] = url_for('.index_job_status', job_id=job.id,
+                                     _external=True)
+    return rv
+
+
+@bp.route('/index/jobs/<job_id>')
+def index_job_status(job_id):
+    info = get_job_manager().load_job_info(job_id)
+    if info is None:
+        abort(404)
+    return jsonify(info)
+
+
+@bp.route('/health')
+def health():
+    index_path = get_index_path()
+    return jsonify(
+        okay=True,
+        version=get_index_version(index_path),
+        warm=get_warmer().is_warm(index_path),
+    )
+
+
+@bp.route('/ready')
+def ready():
+    index_path = get_index_path()
+    is_ready = get_warmer().ensure_warm(index_path)
+    rv = jsonify(ready=is_ready, version=get_index_version(index_path))
+    if not is_ready:
+        rv.status_code = 503
+    return rv
 
-    def generate():
-        for event in index_tree(config, from_zip=archive,
-                                index_path=index_path):
-            yield '%s\n' % event.encode('utf-8')
-    return Response(generate(), direct_passthrough=True,
-                    headers={'X-Accel-Buffering': 'no'},
-                    mimetype='text/plain')
 
 @bp.route('/index', methods=['DELETE'])
 def delete_index():
@@ -2,10 +2,29 @@ import os
 from flask import Flask
 from raven.contrib.flask import Sentry
 
+from rigidsearch.utils import LRUCache
+
 
 env_config = [
     ('SEARCH_INDEX_PATH', '/tmp/testindex'),
     ('SEARCH_INDEX_SECRET', 'supersecretnotreallythough'),
+    ('SEARCH_INDEX_BUILD_WORKERS', '1'),
+    ('SEARCH_PROCESSING_CACHE_PATH', None),
+    ('SEARCH_PROCESSING_CACHE_SIZE', str(256 * 1024 * 1024)),
+    ('SEARCH_CACHE_MAX_AGE', '60'),
+    ('SEARCH_RESPONSE_CACHE_SIZE', '1024'),
+    ('SEARCH_COMPRESS_MIN_SIZE', '512'),
+    ('SEARCH_WARMUP_QUERIES', None),
+    ('SEARCH_WARMUP_RECENT_QUERIES', '50'),
+    ('SEARCH_QUERY_LOG_PATH', None),
+    ('SEARCH_QUERY_LOG_SAMPLE_RATE', '1.0'),
+    ('SEARCH_PROFILE_PATH', None),
+    ('SEARCH_PROFILE_THRESHOLD', None),
+    ('SEARCH_MAX_PER_PAGE', '100'),
+    ('SEARCH_MAX_EXCERPT_CHARS', '1000'),
+    ('SEARCH_MAX_EXCERPT_SURROUND', '200'),
+    ('SEARCH_MAX_TERM_EXPANSIONS', '1000'),
+    ('SEARCH_TIME_LIMIT', '2.0'),
 ]
 
 sentry = Sentry()
@@ -29,6 +48,9 @@ def create_app(config_filename=None, config=None):
     if config_filename:
         app.config.from_pyfile(config_filename)
 
+    app.extensions['rigidsearch_responses'] = LRUCache(
+        int(app.config['SEARCH_RESPONSE_CACHE_SIZE']))
+
     from rigidsearch.api import bp as api_bp
     app.register_blueprint(api_bp)
 
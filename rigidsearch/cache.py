@@ -0,0 +1,83 @@
+import os
+import json
+import uuid
+import errno
+import hashlib
+
+
+class ProcessingCache(object):
+    """A content addressed cache for the documents the HTML processor
+    extracts from a file.  It lives next to (not inside) the index
+    versions so that it survives rebuilds and is bounded in size; the
+    least recently used entries are evicted by :meth:`prune`.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+
+    def make_key(self, checksum, processor, path):
+        # the extracted documents depend on the path (priority and the
+        # sub-document paths are derived from it) so it's part of the key.
+        h = hashlib.sha1()
+        h.update(checksum)
+        h.update('\x00')
+        h.update(processor.get_config_hash())
+        h.update('\x00')
+        h.update(path.encode('utf-8'))
+        return h.hexdigest()
+
+    def get_filename(self, key):
+        return os.path.join(self.path, key[:2], key[2:])
+
+    def get(self, key):
+        fn = self.get_filename(key)
+        try:
+            with open(fn, 'rb') as f:
+                rv = json.load(f)
+        except (IOError, ValueError) as e:
+            if getattr(e, 'errno', None) not in (None, errno.ENOENT):
+                raise
+            return None
+        try:
+            os.utime(fn, None)
+        except OSError:
+            pass
+        return rv
+
+    def set(self, key, docs):
+        fn = self.get_filename(key)
+        try:
+            os.makedirs(os.path.dirname(fn))
+        except OSError:
+            pass
+        tmp = '%s.%s.tmp' % (fn, uuid.uuid4().hex)
+        with open(tmp, 'wb') as f:
+            json.dump(docs, f)
+        os.rename(tmp, fn)
+
+    def prune(self):
+        """Evicts the least recently used entries until the cache fits
+        into its size limit again.
+        """
+        entries = []
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for filename in filenames:
+                fn = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(fn)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, fn))
+                total += st.st_size
+
+        entries.sort()
+        for mtime, size, fn in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
+            total -= size
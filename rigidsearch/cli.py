@@ -1,6 +1,5 @@
 # coding: utf-8
 import os
-import shutil
 import json
 import click
 
@@ -37,32 +36,52 @@ def cli(ctx, config):
 @click.option('--save-zip', type=click.File('wb'),
               help='Optional a zip file the index should be stored at '
               'instead of modifying the index in-place.')
+@click.option('--progress', type=click.Choice(['summary', 'json',
+                                               'verbose']),
+              default='summary', help='How progress is reported.  '
+              'Summary and json only report periodically, verbose reports '
+              'every document.')
+@click.option('--profile-path', type=click.Path(),
+              help='Writes a profile of the indexing of every source into '
+              'this folder.')
 @pass_ctx
-def index_folder_cmd(ctx, config, index_path, save_zip):
+def index_folder_cmd(ctx, config, index_path, save_zip, progress,
+                     profile_path):
     """Indexes a path."""
-    from rigidsearch.search import index_tree, get_index_path
+    from rigidsearch.search import index_tree, get_index_path, \
+         get_processing_cache
+    from rigidsearch.progress import iter_reports
+    from rigidsearch.profiling import Profiler
+    from rigidsearch.warmup import get_warmer
     index_path = get_index_path(index_path=index_path, app=ctx.app)
-    try:
-        shutil.rmtree(index_path)
-    except (OSError, IOError):
-        pass
-    for event in index_tree(json.load(config), index_zip=save_zip,
-                            index_path=index_path):
-        click.echo(event)
+    cache = get_processing_cache(index_path, app=ctx.app)
+    profiler = None
+    if profile_path is not None:
+        profiler = Profiler(profile_path)
+    events = index_tree(json.load(config), index_zip=save_zip,
+                        index_path=index_path, copy=False,
+                        cache=cache, warmup=get_warmer(ctx.app).warm,
+                        profiler=profiler)
+    for event in iter_reports(events, mode=progress):
+        if progress == 'json':
+            click.echo(json.dumps(event.to_dict()))
+        else:
+            click.echo(unicode(event))
 
 
 @cli.command('search')
 @click.argument('query')
-@click.option('--section', default='generic')
+@click.option('--section', default='generic',
+              help='The sections to search, comma separated or * for all.')
 @click.option('--index-path', help='Path to the search index.')
 @pass_ctx
 def search_cmd(ctx, query, section, index_path):
     """Triggers a search from the command line."""
-    from rigidsearch.search import get_index, get_index_path
+    from rigidsearch.search import get_index_path, parse_sections, \
+         search_sections
 
-    index_path = get_index_path(app=ctx.app)
-    index = get_index(index_path)
-    results = index.search(query, section=section)
+    index_path = get_index_path(index_path=index_path, app=ctx.app)
+    results = search_sections(index_path, query, parse_sections([section]))
     for result in results['items']:
         click.echo('%s (%s)' % (
             result['path'],
@@ -70,6 +89,43 @@ def search_cmd(ctx, query, section, index_path):
         ))
 
 
+@cli.command('replay')
+@click.argument('query_logs', nargs=-1, required=True,
+                type=click.File('rb'))
+@click.option('--index-path', help='Path to the search index.')
+@click.option('--concurrency', '-c', default=4,
+              help='The number of queries to run in parallel.')
+@click.option('--repeat', default=1,
+              help='How many times the log should be replayed.')
+@pass_ctx
+def replay_cmd(ctx, query_logs, index_path, concurrency, repeat):
+    """Replays captured query logs against a local index.  Every server
+    process writes its own log, all of them can be given at once.
+    """
+    from rigidsearch.search import get_index_path
+    from rigidsearch.querylog import iter_query_log, replay_queries, \
+         percentile
+
+    index_path = get_index_path(index_path=index_path, app=ctx.app)
+    entries = [entry for query_log in query_logs
+               for entry in iter_query_log(query_log)] * repeat
+    rv = replay_queries(index_path, entries, concurrency=concurrency)
+
+    total = sum(len(x) for x in rv['latencies'].itervalues())
+    click.echo('%d queries in %.2fs (%.1f queries/sec), %d failed' % (
+        total, rv['duration'], total / (rv['duration'] or 1),
+        len(rv['failures'])))
+    click.echo('%-24s %8s %9s %9s %9s %9s' % (
+        'class', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    for cls, latencies in sorted(rv['latencies'].iteritems()):
+        click.echo('%-24s %8d %9.1f %9.1f %9.1f %9.1f' % (
+            cls, len(latencies),
+            percentile(latencies, 50) * 1000,
+            percentile(latencies, 90) * 1000,
+            percentile(latencies, 99) * 1000,
+            max(latencies) * 1000))
+
+
 @cli.command('devserver')
 @click.option('--bind', '-b', default='127.0.0.1:5001')
 @pass_ctx
@@ -1,8 +1,15 @@
-import os
+import sys
+import time
 import errno
+import heapq
 import hashlib
 
-from rigidsearch.utils import chop_tail
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+from rigidsearch.utils import chop_tail, start_native_thread, NativeQueue
 
 
 def filename_to_path(filename, base):
@@ -15,22 +22,69 @@ def filename_to_path(filename, base):
     return filename.decode('utf-8', 'replace')
 
 
+def iter_documents(base, ignore=None):
+    """Walks the path and yields ``(path, filename)`` tuples for all HTML
+    documents.  Symlinked directories are not followed.  ``foo.html`` and
+    ``foo/index.html`` both map to ``foo``, like in
+    :func:`iter_sorted_documents` only the first one is yielded.
+    """
+    seen = set()
+    stack = [base]
+    while stack:
+        dirpath = stack.pop()
+        try:
+            entries = sorted(scandir(dirpath), key=lambda x: x.name)
+        except OSError:
+            continue
+        subdirs = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name[:1] != '.':
+                    subdirs.append(entry.path)
+            elif entry.name.endswith('.html'):
+                path = filename_to_path(entry.path, base)
+                if path not in seen and (not ignore or path not in ignore):
+                    seen.add(path)
+                    yield path, entry.path
+        stack.extend(reversed(subdirs))
+
+
+def iter_sorted_documents(base, ignore=None):
+    """Like :func:`iter_documents` but yields the documents ordered by
+    their path without loading the whole tree.  Directories are kept on a
+    heap keyed by their own path, which sorts before anything inside of
+    them, and are only scanned once they reach the top.  Each path is
+    only yielded once.
+    """
+    base = base.rstrip('/')
+    heap = [(u'', True, base)]
+    last_path = None
+    while heap:
+        path, is_dir, filename = heapq.heappop(heap)
+        if not is_dir:
+            if path != last_path and (not ignore or path not in ignore):
+                last_path = path
+                yield path, filename
+            continue
+        try:
+            entries = list(scandir(filename))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name[:1] != '.':
+                    heapq.heappush(heap, (filename_to_path(
+                        entry.path, base), True, entry.path))
+            elif entry.name.endswith('.html'):
+                heapq.heappush(heap, (filename_to_path(entry.path, base),
+                                      False, entry.path))
+
+
 def find_all_documents(base, ignore=None):
     """Finds all HTML documents on the path and returns them as a dictionary
     as a mapping of path to source filename.
     """
-    rv = {}
-
-    for dirpath, dirnames, filenames in os.walk(base):
-        dirnames[:] = [x for x in dirnames if x[:1] != '.']
-        for filename in filenames:
-            if filename.endswith('.html'):
-                full_filename = os.path.join(dirpath, filename)
-                path = filename_to_path(full_filename, base)
-                if not ignore or path not in ignore:
-                    rv[path] = full_filename
-
-    return rv
+    return dict(iter_documents(base, ignore))
 
 
 def get_file_checksum(filename):
@@ -52,3 +106,75 @@ def get_file_checksum(filename):
 def file_changed(filename, reference_checksum):
     checksum = get_file_checksum(filename)
     return checksum != reference_checksum
+
+
+def iter_checksums(items, workers=8, stats=None):
+    """Given an iterable of ``(tag, filename)`` tuples this yields
+    ``(tag, checksum)`` tuples with the files hashed concurrently on a
+    pool of threads.  If the filename is `None` the item is passed through
+    with a `None` checksum.  The items are consumed on a background thread
+    and only a bounded number of them is in flight at any time, so results
+    are streamed as soon as they are available and the order is not
+    preserved.  The time spent hashing is recorded on the optional
+    stats object.  The workers are native threads so the files are also
+    read concurrently under gevent.
+    """
+    in_q = NativeQueue(workers * 4)
+    out_q = NativeQueue(workers * 4)
+    stopped = []
+    done = object()
+
+    def _feed():
+        try:
+            for item in items:
+                if stopped:
+                    break
+                in_q.put(item)
+        except Exception:
+            out_q.put((None, None, sys.exc_info()))
+        finally:
+            for _ in xrange(workers):
+                in_q.put(done)
+
+    def _work():
+        while 1:
+            item = in_q.get()
+            if item is done:
+                out_q.put(done)
+                return
+            if stopped:
+                continue
+            tag, filename = item
+            try:
+                if filename is None:
+                    checksum = None
+                else:
+                    start = time.time()
+                    checksum = get_file_checksum(filename)
+                    if stats is not None:
+                        stats.add_time('hash', time.time() - start)
+            except Exception:
+                out_q.put((None, None, sys.exc_info()))
+            else:
+                out_q.put((tag, checksum, None))
+
+    start_native_thread(_feed)
+    for _ in xrange(workers):
+        start_native_thread(_work)
+
+    running = workers
+    try:
+        while running:
+            rv = out_q.get()
+            if rv is done:
+                running -= 1
+                continue
+            tag, checksum, exc_info = rv
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            yield tag, checksum
+    finally:
+        stopped.append(True)
+        while running:
+            if out_q.get() is done:
+                running -= 1
@@ -1,4 +1,6 @@
 import re
+import json
+import hashlib
 import html5lib
 import warnings
 from lxml.cssselect import CSSSelector
@@ -31,11 +33,19 @@ class Processor(object):
                  content_scoring=None,
                  ignore=None,
                  no_default_ignores=False):
+        self.config = {
+            'title_cleanup_regex': title_cleanup_regex,
+            'content_selectors': content_selectors,
+            'content_sections': content_sections,
+            'content_scoring': content_scoring,
+            'ignore': ignore,
+            'no_default_ignores': no_default_ignores,
+        }
         self.content_selectors = [compile_selector(sel) for sel in
                                   content_selectors or ('body',)]
         self.content_sections = [compile_selector(sel) for sel in
                                   content_sections or ('body',)]
-        self.content_scoring = content_scoring
+        self.content_scoring = content_scoring or {}
         if title_cleanup_regex is not None:
             title_cleanup_regex = re.compile(title_cleanup_regex, re.UNICODE)
         self.title_cleanup_regex = title_cleanup_regex
@@ -55,6 +65,13 @@ class Processor(object):
             no_default_ignores=config.get('no_default_ignores', False),
         )
 
+    def get_config_hash(self):
+        """Returns a checksum over the configuration of the processor.
+        Two processors with the same hash extract the same documents.
+        """
+        return hashlib.sha1(json.dumps(self.config, sort_keys=True)) \
+            .hexdigest()
+
     def is_ignored(self, node):
         for sel in self.ignore:
             xpath = sel.path.replace('descendant-or-self::', 'self::')
@@ -63,12 +80,14 @@ class Processor(object):
                 return True
         return False
 
-    def process_document(self, document, path):
+    def parse_document(self, document):
         if isinstance(document, basestring):
             document = StringIO(document)
-        doc = html5lib.parse(document, treebuilder='lxml',
-                             namespaceHTMLElements=False)
-        return self.process_tree(doc, path)
+        return html5lib.parse(document, treebuilder='lxml',
+                              namespaceHTMLElements=False)
+
+    def process_document(self, document, path):
+        return self.process_tree(self.parse_document(document), path)
 
     def process_title_tag(self, title):
         if title is None:
@@ -80,22 +99,34 @@ class Processor(object):
                 text = match.group(1)
         return unicode(text)
 
-    def process_content_tag(self, body):
+    def process_content_tag(self, body, spans=None, offset=0):
+        """Extracts the text of a tag.  If a dictionary of `spans` is
+        given, the ``(start, end)`` offsets of the text of the elements
+        that are keys in it are recorded, shifted by `offset`.
+        """
         if body is None:
             return u''
 
         buf = []
+        pos = [offset]
+
+        def _append(text):
+            buf.append(text)
+            pos[0] += len(text)
 
         def _walk(node):
             if self.is_ignored(node):
                 return
 
+            start = pos[0]
             if node.text:
-                buf.append(node.text)
+                _append(node.text)
             for child in node:
                 _walk(child)
+            if spans is not None and node in spans:
+                spans[node] = (start, pos[0])
             if node.tail:
-                buf.append(node.tail)
+                _append(node.tail)
 
         _walk(body)
 
@@ -119,27 +150,41 @@ class Processor(object):
         else:
             doc['priority'] = 0
 
+        sections = []
+        for sel in self.content_sections:
+            for el in sel(root):
+                sections.append(el)
+
+        # sections within the content are recorded as spans of the page
+        # text instead of being extracted a second time.
+        spans = dict.fromkeys(sections)
         buf = []
+        offset = 0
         for sel in self.content_selectors:
             for el in sel(root):
-                buf.append(self.process_content_tag(el))
+                text = self.process_content_tag(el, spans, offset)
+                buf.append(text)
+                offset += len(text)
 
         doc['text'] = u''.join(buf).rstrip()
         docs.append(doc)
 
-        for sel in self.content_sections:
-            for el in sel(root):
-                if el.attrib['id'] and el.attrib['id'] not in path:
-                    p = str(path).split("/")[0]
-                    if p and p in self.content_scoring:
-                        priority = int(self.content_scoring[p])
-                    else:
-                        priority = 0
-                    title = [w.capitalize() for w in el.attrib['id'].split("-")]
-                    docs.append({
-                        'path': path + "#" + el.attrib['id'],
-                        'title': u' '.join(title),
-                        'text': self.process_content_tag(el),
-                        'priority': priority + 1
-                    })
+        for el in sections:
+            if el.attrib.get('id') and el.attrib['id'] not in path:
+                p = str(path).split("/")[0]
+                if p and p in self.content_scoring:
+                    priority = int(self.content_scoring[p])
+                else:
+                    priority = 0
+                title = [w.capitalize() for w in el.attrib['id'].split("-")]
+                sub_doc = {
+                    'path': path + "#" + el.attrib['id'],
+                    'title': u' '.join(title),
+                    'priority': priority + 1
+                }
+                if spans[el] is not None:
+                    sub_doc['span'] = spans[el]
+                else:
+                    sub_doc['text'] = self.process_content_tag(el)
+                docs.append(sub_doc)
         return docs
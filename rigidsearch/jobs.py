@@ -0,0 +1,240 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import errno
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from flask import current_app
+
+from rigidsearch.progress import IndexStats
+from rigidsearch.utils import get_native, start_native_thread
+
+
+_manager_lock = threading.Lock()
+
+
+class IndexJob(object):
+    """Tracks the progress of a single background index build.  The state
+    is mirrored into a json file below the index path so that every worker
+    process can report on a job, not just the one that runs it.
+    """
+
+    def __init__(self, manager, key, func):
+        self.manager = manager
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.func = func
+        self.status = 'queued'
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.stats = []
+        # the number of source documents, known once they were counted
+        self.total = None
+        self.current_section = None
+        self.last_event = None
+        self.error = None
+        self._last_saved = 0
+
+    @property
+    def active(self):
+        return self.status in ('queued', 'running')
+
+    def handle_event(self, event):
+        """Updates the job from an index event."""
+        # the final event carries the totals which are summed up here
+        if event.type == 'done':
+            return
+        if event.type == 'discover':
+            self.total = event.total
+            self.last_event = event.message
+            self.save()
+            return
+        if not any(x is event.stats for x in self.stats):
+            self.stats.append(event.stats)
+        self.current_section = event.section
+        self.last_event = event.message
+        self.save()
+
+    def to_dict(self):
+        totals = IndexStats.combine(self.stats)
+        rate = None
+        eta = None
+        if self.started is not None:
+            elapsed = (self.finished or time.time()) - self.started
+            if elapsed > 0:
+                rate = totals.processed / elapsed
+            # unchanged documents are only hashed, so the estimate is
+            # based on the documents examined so far, not the ones that
+            # had to be indexed.
+            if self.total is not None and totals.examined and \
+               self.status == 'running':
+                eta = max(self.total - totals.examined, 0) * \
+                    elapsed / totals.examined
+        return {
+            'id': self.id,
+            'key': self.key,
+            'status': self.status,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'total': self.total,
+            'examined': totals.examined,
+            'processed': totals.processed,
+            'bytes': totals.bytes,
+            'stage_times': totals.stage_times,
+            'docs_per_sec': rate,
+            'eta': eta,
+            'section': self.current_section,
+            'sections': [x.to_dict() for x in self.stats],
+            'last_event': self.last_event,
+            'error': self.error,
+        }
+
+    def save(self, force=False):
+        now = time.time()
+        if not force and now - self._last_saved < 1.0:
+            return
+        self._last_saved = now
+        self.manager.store_job_info(self.id, self.to_dict())
+
+    def run(self):
+        try:
+            # builds in other processes are waited for while queued
+            with self.manager.build_lock():
+                self.status = 'running'
+                self.started = time.time()
+                self.save(force=True)
+                self.func(self)
+        except Exception as e:
+            self.status = 'failed'
+            self.error = '%s: %s' % (e.__class__.__name__, e)
+            self.manager.app.logger.exception('Index build %s failed',
+                                              self.id)
+        else:
+            self.status = 'done'
+        self.finished = time.time()
+        self.save(force=True)
+
+
+class JobManager(object):
+    """A bounded executor for index builds.  Builds for the same key that
+    are still queued or running are de-duplicated, everything else waits
+    in the queue until one of the workers is free.
+
+    The workers are native threads so that a build does not block the
+    gevent workers of the production server, and builds are serialized
+    across processes with a lock file.
+    """
+
+    def __init__(self, app, max_workers=1):
+        self.app = app
+        self.max_workers = max_workers
+        # a native lock as it is shared with the native worker threads
+        self._lock = get_native('allocate_lock')()
+        self._pending = deque()
+        self._running = 0
+        self._jobs = {}
+
+    def get_job_path(self):
+        return os.path.join(self.app.config['SEARCH_INDEX_PATH'], 'jobs')
+
+    def store_job_info(self, job_id, info):
+        path = self.get_job_path()
+        try:
+            os.makedirs(path)
+        except OSError:
+            pass
+        fn = os.path.join(path, job_id + '.json')
+        tmp = '%s.%s.tmp' % (fn, uuid.uuid4().hex)
+        with open(tmp, 'wb') as f:
+            json.dump(info, f)
+        os.rename(tmp, fn)
+
+    def load_job_info(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        if not job_id.isalnum():
+            return None
+        try:
+            with open(os.path.join(self.get_job_path(),
+                                   job_id + '.json'), 'rb') as f:
+                return json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def find_active_job(self, key):
+        for job in self._jobs.itervalues():
+            if job.key == key and job.active:
+                return job
+
+    def submit(self, key, func):
+        """Submits a new build.  Returns a tuple in the form
+        ``(job, created)``.
+        """
+        with self._lock:
+            job = self.find_active_job(key)
+            if job is not None:
+                return job, False
+            job = IndexJob(self, key, func)
+            self._jobs[job.id] = job
+            job.save(force=True)
+            self._pending.append(job)
+            while self._running < min(self.max_workers,
+                                      len(self._pending)):
+                self._running += 1
+                start_native_thread(self._worker)
+            return job, True
+
+    @contextmanager
+    def build_lock(self):
+        """Holds the lock that serializes builds across processes."""
+        path = self.get_job_path()
+        try:
+            os.makedirs(path)
+        except OSError:
+            pass
+        with open(os.path.join(path, 'build.lock'), 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _worker(self):
+        while 1:
+            with self._lock:
+                if not self._pending:
+                    self._running -= 1
+                    return
+                job = self._pending.popleft()
+            try:
+                with self.app.app_context():
+                    job.run()
+            finally:
+                job.func = None
+
+    def join(self):
+        while 1:
+            with self._lock:
+                if not self._pending and not self._running:
+                    return
+            time.sleep(0.05)
+
+
+def get_job_manager(app=None):
+    if app is None:
+        app = current_app._get_current_object()
+    with _manager_lock:
+        rv = app.extensions.get('rigidsearch_jobs')
+        if rv is None:
+            workers = int(app.config['SEARCH_INDEX_BUILD_WORKERS'])
+            rv = app.extensions['rigidsearch_jobs'] = JobManager(
+                app, max_workers=workers)
+        return rv
@@ -0,0 +1,137 @@
+import os
+import re
+import sys
+import time
+import uuid
+import cProfile
+import threading
+from contextlib import contextmanager
+
+from flask import current_app
+
+from rigidsearch.utils import get_native, start_native_thread
+
+
+_profiler_lock = threading.Lock()
+_unsafe_chars_re = re.compile(r'[^a-zA-Z0-9_.-]+')
+
+
+class StackSampler(object):
+    """Samples the stack of a thread in regular intervals from a
+    background thread and counts the collapsed stacks, the input format
+    of flamegraph tools.
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self._stopped = False
+
+    def start(self):
+        # with gevent's monkey patching a regular thread would be a
+        # greenlet that never gets to run while the request hogs the CPU,
+        # so the sampler needs a real thread.
+        start_native_thread(self._run)
+
+    def stop(self):
+        self._stopped = True
+
+    def _run(self):
+        while not self._stopped:
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (
+                    code.co_name, os.path.basename(code.co_filename),
+                    frame.f_lineno))
+                frame = frame.f_back
+            key = ';'.join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def dump(self, filename):
+        with open(filename, 'wb') as f:
+            for stack, count in sorted(self.stacks.iteritems()):
+                f.write('%s %d\n' % (stack, count))
+
+
+class Profiler(object):
+    """Captures profiles into a directory.  Deterministic profiles are
+    written as ``.pstats`` files, sampled ones as collapsed stacks in
+    ``.folded`` files which can be rendered with flamegraph tools.
+    """
+
+    def __init__(self, path, threshold=None, interval=0.005):
+        self.path = path
+        self.threshold = threshold
+        self.interval = interval
+
+    def make_filename(self, name, ext):
+        try:
+            os.makedirs(self.path)
+        except OSError:
+            pass
+        return os.path.join(self.path, '%s-%s-%s.%s' % (
+            time.strftime('%Y%m%d-%H%M%S'),
+            _unsafe_chars_re.sub('_', name).strip('_')[:60],
+            uuid.uuid4().hex[:8], ext))
+
+    @contextmanager
+    def profile(self, name, deterministic=False):
+        """Profiles the wrapped block.  A deterministic profile is always
+        stored, a sampled one only if the block ran longer than the
+        threshold.
+        """
+        if deterministic:
+            prof = cProfile.Profile()
+            prof.enable()
+            try:
+                yield
+            finally:
+                prof.disable()
+                prof.dump_stats(self.make_filename(name, 'pstats'))
+            return
+
+        # under gevent the ident of the current thread is the one of the
+        # greenlet which does not show up in the frames of the interpreter.
+        sampler = StackSampler(get_native('get_ident')(), self.interval)
+        sampler.start()
+        start = time.time()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            if self.threshold is None or \
+               time.time() - start >= self.threshold:
+                sampler.dump(self.make_filename(name, 'folded'))
+
+    def list_profiles(self):
+        try:
+            return sorted(x for x in os.listdir(self.path)
+                          if x.endswith(('.pstats', '.folded')))
+        except OSError:
+            return []
+
+
+def get_profiler(app=None):
+    """Returns the profiler of the application or `None` if profiling is
+    disabled.
+    """
+    if app is None:
+        app = current_app._get_current_object()
+    path = app.config.get('SEARCH_PROFILE_PATH')
+    if not path:
+        return None
+    with _profiler_lock:
+        rv = app.extensions.get('rigidsearch_profiler')
+        if rv is None:
+            threshold = app.config.get('SEARCH_PROFILE_THRESHOLD')
+            if threshold is not None:
+                threshold = float(threshold)
+            rv = app.extensions['rigidsearch_profiler'] = Profiler(
+                path, threshold=threshold)
+        return rv
@@ -0,0 +1,157 @@
+import time
+import threading
+from contextlib import contextmanager
+
+
+STAGES = ('hash', 'parse', 'extract', 'write', 'commit')
+
+
+class IndexStats(object):
+    """Counters and per stage timings for the indexing of one source."""
+
+    def __init__(self, section=None):
+        self.section = section
+        self.started = time.time()
+        self.finished = None
+        self.found = 0
+        self.examined = 0
+        self.indexed = 0
+        self.removed = 0
+        self.bytes = 0
+        self.stage_times = dict.fromkeys(STAGES, 0.0)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def combine(cls, stats, section=None):
+        """Sums up a list of stats into a new one."""
+        rv = cls(section)
+        for item in stats:
+            rv.started = min(rv.started, item.started)
+            rv.found += item.found
+            rv.examined += item.examined
+            rv.indexed += item.indexed
+            rv.removed += item.removed
+            rv.bytes += item.bytes
+            for stage, seconds in item.stage_times.iteritems():
+                rv.stage_times[stage] += seconds
+        rv.finished = time.time()
+        return rv
+
+    @property
+    def processed(self):
+        return self.indexed + self.removed
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def docs_per_sec(self):
+        elapsed = self.elapsed
+        if elapsed > 0:
+            return self.processed / elapsed
+        return 0.0
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            self.stage_times[stage] += seconds
+
+    @contextmanager
+    def measure(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.time() - start)
+
+    def to_dict(self):
+        return {
+            'section': self.section,
+            'found': self.found,
+            'examined': self.examined,
+            'indexed': self.indexed,
+            'removed': self.removed,
+            'bytes': self.bytes,
+            'elapsed': self.elapsed,
+            'docs_per_sec': self.docs_per_sec,
+            'stage_times': dict(self.stage_times),
+        }
+
+
+class IndexEvent(object):
+    """An event emitted while indexing.  The type is ``discover`` at the
+    start with the number of source documents as `total`, one of
+    ``index`` and ``remove`` for single documents, ``progress`` for
+    periodic summaries, ``section`` once a source is done and ``done`` at
+    the very end.  Converted to text it gives a human readable message.
+    """
+
+    def __init__(self, type, stats, path=None, total=None):
+        self.type = type
+        self.stats = stats
+        self.path = path
+        self.total = total
+
+    @property
+    def section(self):
+        return self.stats.section
+
+    @property
+    def message(self):
+        stats = self.stats
+        if self.type == 'discover':
+            return u'Found %d documents' % self.total
+        elif self.type == 'index':
+            return u'Indexing %s (%s)' % (self.path, self.section)
+        elif self.type == 'remove':
+            return u'Removing %s (%s)' % (self.path, self.section)
+        elif self.type == 'progress':
+            return u'Progress %s: %d documents examined, %d changed, ' \
+                u'%.1f docs/sec' % (self.section, stats.examined,
+                                    stats.processed, stats.docs_per_sec)
+        elif self.type == 'section':
+            return u'Finished %s: %d indexed, %d removed, %d bytes in ' \
+                u'%.2fs (%s)' % (
+                    self.section, stats.indexed, stats.removed, stats.bytes,
+                    stats.elapsed, format_stage_times(stats))
+        return u'Done!'
+
+    def to_dict(self):
+        rv = {'type': self.type, 'stats': self.stats.to_dict()}
+        if self.path is not None:
+            rv['path'] = self.path
+        if self.total is not None:
+            rv['total'] = self.total
+        return rv
+
+    def __unicode__(self):
+        return self.message
+
+    def __str__(self):
+        return self.message.encode('utf-8')
+
+    def __repr__(self):
+        return '<IndexEvent %r>' % self.message
+
+
+def format_stage_times(stats):
+    return u', '.join(u'%s %.2fs' % (stage, stats.stage_times[stage])
+                      for stage in STAGES)
+
+
+def iter_reports(events, mode='summary', interval=2.0):
+    """Filters a stream of index events down to what should be reported.
+    In ``verbose`` mode every event is passed through, otherwise document
+    events are replaced by a progress summary at most every `interval`
+    seconds.
+    """
+    last_report = time.time()
+    for event in events:
+        if mode == 'verbose' or event.type in ('discover', 'section',
+                                               'done'):
+            yield event
+            continue
+        now = time.time()
+        if now - last_report >= interval:
+            last_report = now
+            yield IndexEvent('progress', event.stats)
@@ -0,0 +1,192 @@
+import os
+import json
+import time
+import random
+import logging
+import threading
+from Queue import Queue, Full, Empty
+from logging.handlers import RotatingFileHandler
+
+from flask import current_app
+
+from rigidsearch.search import parse_sections, search_sections
+from rigidsearch.utils import start_native_thread, NativeQueue
+
+
+_log_lock = threading.Lock()
+
+# the search arguments that are recorded and replayed
+SEARCH_ARGS = ('q', 'section', 'page', 'per_page', 'excerpt_fragmenter',
+               'excerpt_maxchars', 'excerpt_surround')
+
+
+def make_log_filename(path, pid=None):
+    """Returns the log file of a process.  Each process needs its own
+    file as processes that rotate a shared file lose entries.  The pid
+    goes in front of the extension: ``queries.log`` becomes
+    ``queries.1234.log``.
+    """
+    if pid is None:
+        pid = os.getpid()
+    root, ext = os.path.splitext(path)
+    return '%s.%d%s' % (root, pid, ext)
+
+
+class QueryLog(object):
+    """Records a sample of the search requests into a rotating file per
+    process.  The file is written on a native background thread so the
+    disk writes do not stall the gevent hub, and entries are dropped
+    rather than blocking the request if the writer falls behind.
+    """
+
+    def __init__(self, path, sample_rate=1.0, max_bytes=50 * 1024 * 1024,
+                 backup_count=5, queue_size=1000):
+        self.path = path
+        self.filename = make_log_filename(path)
+        self.sample_rate = sample_rate
+        self._queue = NativeQueue(queue_size)
+        self._handler = RotatingFileHandler(
+            self.filename, maxBytes=max_bytes, backupCount=backup_count)
+        self._handler.setFormatter(logging.Formatter('%(message)s'))
+        # only the writer thread uses the handler, and its lock would be a
+        # greenlet lock under gevent
+        self._handler.lock = None
+        start_native_thread(self._writer)
+
+    def should_sample(self):
+        return self.sample_rate >= 1.0 or random.random() < self.sample_rate
+
+    def record(self, args, latency, **extra):
+        entry = dict((key, args.get(key)) for key in SEARCH_ARGS
+                     if args.get(key) is not None)
+        if len(args.getlist('section')) > 1:
+            entry['section'] = u','.join(args.getlist('section'))
+        entry['ts'] = time.time()
+        entry['latency'] = latency
+        entry.update(extra)
+        try:
+            self._queue.put_nowait(entry)
+        except Full:
+            pass
+
+    def _writer(self):
+        while 1:
+            entry = self._queue.get()
+            try:
+                self._handler.emit(logging.makeLogRecord({
+                    'msg': json.dumps(entry),
+                }))
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """Waits until the writer has written all recorded entries.  This
+        blocks the calling thread and is meant for tests and shutdown.
+        """
+        self._queue.join()
+
+
+def get_query_log(app=None):
+    """Returns the query log of the application or `None` if logging of
+    queries is disabled.
+    """
+    if app is None:
+        app = current_app._get_current_object()
+    path = app.config.get('SEARCH_QUERY_LOG_PATH')
+    if not path:
+        return None
+    with _log_lock:
+        rv = app.extensions.get('rigidsearch_query_log')
+        if rv is None:
+            rv = app.extensions['rigidsearch_query_log'] = QueryLog(
+                path, sample_rate=float(
+                    app.config['SEARCH_QUERY_LOG_SAMPLE_RATE']))
+        return rv
+
+
+def classify_query(entry):
+    """Puts a logged query into a rough class so that replay results can
+    be compared between kinds of queries.
+    """
+    q = (entry.get('q') or u'').strip()
+    if not q:
+        rv = 'empty'
+    elif '*' in q or '?' in q:
+        rv = 'wildcard'
+    elif '"' in q:
+        rv = 'phrase'
+    elif len(q.split()) > 1:
+        rv = 'multi-term'
+    else:
+        rv = 'single-term'
+    if entry.get('excerpt_fragmenter') == 'sentence':
+        rv += '/sentence'
+    return rv
+
+
+def iter_query_log(f):
+    for line in f:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[idx]
+
+
+def replay_queries(index_path, entries, concurrency=4):
+    """Runs the logged queries against the index on a number of threads
+    and returns a dictionary with the total time, the number of failures
+    and the observed latencies per query class.
+    """
+    queue = Queue()
+    for entry in entries:
+        queue.put(entry)
+    latencies = {}
+    failures = []
+    lock = threading.Lock()
+
+    def _worker():
+        while 1:
+            try:
+                entry = queue.get_nowait()
+            except Empty:
+                return
+            kwargs = dict((key, entry[key]) for key in SEARCH_ARGS[2:]
+                          if entry.get(key) is not None)
+            for key in 'page', 'per_page', 'excerpt_maxchars', \
+                    'excerpt_surround':
+                if key in kwargs:
+                    kwargs[key] = int(kwargs[key])
+            start = time.time()
+            try:
+                search_sections(index_path, entry.get('q') or u'',
+                                parse_sections([entry.get('section') or '']),
+                                **kwargs)
+            except Exception as e:
+                with lock:
+                    failures.append((entry, e))
+                continue
+            latency = time.time() - start
+            with lock:
+                latencies.setdefault(classify_query(entry), []) \
+                    .append(latency)
+
+    start = time.time()
+    threads = [threading.Thread(target=_worker)
+               for _ in xrange(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return {
+        'duration': time.time() - start,
+        'failures': failures,
+        'latencies': latencies,
+    }
@@ -1,26 +1,44 @@
 # -*- coding: utf-8 -*-
 import os
+import re
 import sys
+import time
 import uuid
 import errno
+import logging
 import shutil
 import zipfile
 import hashlib
 import tempfile
+import threading
+from itertools import islice
+from collections import OrderedDict, deque
 from contextlib import contextmanager
 from whoosh import index, sorting, columns
 from whoosh.fields import Schema, TEXT, ID, STORED, COLUMN
 from whoosh.qparser import MultifieldParser
-from whoosh.query import Term, And
+from whoosh.query import Term, And, Or, Prefix
+from whoosh.query.terms import MultiTerm
+from whoosh.searching import ResultsPage
+from whoosh.collectors import WrappingCollector, TimeLimit
+from whoosh.compat import htmlescape
 from whoosh.highlight import HtmlFormatter, ContextFragmenter, \
      SentenceFragmenter
 from whoosh.analysis import StandardAnalyzer
 
 from flask import current_app
 
-from rigidsearch.utils import normalize_text
+from rigidsearch.utils import normalize_text, normalize_text_spans, \
+     start_native_thread, NativeQueue
 from rigidsearch.htmlprocessor import Processor
-from rigidsearch.fs import find_all_documents, file_changed
+from rigidsearch.cache import ProcessingCache
+from rigidsearch.progress import IndexEvent, IndexStats
+from rigidsearch.fs import iter_documents, iter_sorted_documents, \
+     iter_checksums
+
+
+logger = logging.getLogger(__name__)
+_safe_section_re = re.compile(r'^[a-zA-Z0-9_.-]+$')
 
 
 def make_fragmenter_and_analyzer(type=None, maxchars=None, surround=None):
@@ -46,6 +64,35 @@ def make_html_formatter():
     )
 
 
+def make_plain_excerpt(text, maxchars=None):
+    # used instead of a highlighted excerpt once the time budget of a
+    # search is spent.  It is just the escaped beginning of the text.
+    maxchars = maxchars or 300
+    if len(text) > maxchars:
+        words = text[:maxchars].rsplit(None, 1)
+        text = (words[0] if words else u'') + u'\u2026'
+    return htmlescape(text, quote=False)
+
+
+def make_result_items(hits, deadline=None, maxchars=None, section=None):
+    """Turns ``(index, hit)`` tuples into result items.  Returns
+    ``(items, degraded)``, `degraded` is set if excerpts fell back to
+    plain text because the deadline had passed.
+    """
+    items = []
+    degraded = False
+    for index, hit in hits:
+        plain = deadline is not None and time.time() > deadline
+        degraded = degraded or plain
+        items.append({
+            'path': hit['path'],
+            'title': hit['title'],
+            'excerpt': index.get_excerpt(hit, plain, maxchars),
+            'section': section if section is not None else hit['section'],
+        })
+    return items, degraded
+
+
 def make_schema():
     return Schema(
         title=TEXT(stored=True, sortable=True),
@@ -53,7 +100,8 @@ def make_schema():
         section=ID(stored=True),
         checksum=STORED,
         content=TEXT,
-        priority=COLUMN(columns.NumericColumn("i"))
+        priority=COLUMN(columns.NumericColumn("i")),
+        span=STORED
     )
 
 
@@ -80,7 +128,88 @@ def get_index_path(index_path=None, app=None):
     return index_path
 
 
-def get_index(index_path=None, resolve_cur=True):
+def get_shard_path(index_path, section):
+    """Returns the path of the index shard for a section.  Each shard has
+    its own versions and ``cur`` link just like the main index.
+    """
+    if not _safe_section_re.match(section):
+        section = hashlib.sha1(section.encode('utf-8')).hexdigest()
+    return os.path.join(index_path, 'sections', section)
+
+
+def resolve_shard(index_path, section):
+    """Returns the path of the shard for a section if the section was
+    built into a shard, otherwise the path of the main index.
+    """
+    if section is not None:
+        shard_path = get_shard_path(index_path, section)
+        if os.path.islink(os.path.join(shard_path, 'cur')):
+            return shard_path
+    return index_path
+
+
+def iter_shard_paths(index_path):
+    """Yields the paths of all shards that are live."""
+    shards_path = os.path.join(index_path, 'sections')
+    try:
+        shards = sorted(os.listdir(shards_path))
+    except OSError:
+        shards = []
+    for name in shards:
+        shard_path = os.path.join(shards_path, name)
+        if os.path.islink(os.path.join(shard_path, 'cur')):
+            yield shard_path
+
+
+def remove_shards(index_path, keep=()):
+    """Removes the shards of all sections except the ones given.  The
+    ``cur`` link goes first so that searches fall back to the main index
+    right away.
+    """
+    keep = set(get_shard_path(index_path, x) for x in keep)
+    shards_path = os.path.join(index_path, 'sections')
+    try:
+        shards = os.listdir(shards_path)
+    except OSError:
+        return
+    for name in shards:
+        shard_path = os.path.join(shards_path, name)
+        if shard_path in keep:
+            continue
+        try:
+            os.remove(os.path.join(shard_path, 'cur'))
+        except OSError:
+            pass
+        shutil.rmtree(shard_path, ignore_errors=True)
+
+
+def get_index_version(index_path, section=None):
+    """Returns the name of the index version that is currently live (for
+    the given section) or `None` if there is no index yet.
+    """
+    index_path = resolve_shard(index_path, section)
+    try:
+        return os.readlink(os.path.join(index_path, 'cur'))
+    except OSError:
+        return None
+
+
+def get_processing_cache(index_path=None, app=None):
+    if app is None:
+        app = current_app._get_current_object()
+    max_size = int(app.config['SEARCH_PROCESSING_CACHE_SIZE'])
+    if max_size <= 0:
+        return None
+    path = app.config.get('SEARCH_PROCESSING_CACHE_PATH')
+    if path is None:
+        path = os.path.join(get_index_path(index_path, app), 'cache')
+    return ProcessingCache(path, max_size)
+
+
+def get_index(index_path=None, resolve_cur=True, section=None):
+    """Opens the index at the given path.  If a section is provided and it
+    was built into its own shard, the shard is opened instead.
+    """
     schema = make_schema()
 
     def _ensure_index(path):
@@ -92,17 +221,20 @@ def get_index(index_path=None, resolve_cur=True):
     if not resolve_cur:
         return Index(index_path, _ensure_index(index_path), schema)
 
-    cur_idx = os.path.join(index_path, 'cur')
+    shard_path = resolve_shard(index_path, section)
+    if shard_path == index_path:
+        section = None
+    cur_idx = os.path.join(shard_path, 'cur')
 
     if not os.path.exists(cur_idx):
-        real_idx = create_index_version(index_path)
+        real_idx = create_index_version(shard_path)
         os.symlink(os.path.basename(real_idx), cur_idx)
     idx = _ensure_index(cur_idx)
-    return Index(cur_idx, idx, schema)
+    return Index(cur_idx, idx, schema, section=section)
 
 
 @contextmanager
-def place_new_index(index_path, copy=True):
+def place_new_index(index_path, copy=True, warmup=None):
     # Ensure the index exists
     get_index(index_path)
 
@@ -112,6 +244,15 @@ def place_new_index(index_path, copy=True):
     try:
         new_idx = create_index_version(index_path, copy=copy)
         yield new_idx
+        if warmup is not None:
+            # warming up is best effort, it must not fail the build
+            try:
+                warmup(new_idx)
+            except Exception:
+                logger.exception('Warmup of %s failed', new_idx)
+                # the handled error must not look like a failed build
+                # to the check below.
+                sys.exc_clear()
     finally:
         if sys.exc_info()[2] is None:
             os.remove(cur_idx)
@@ -125,13 +266,16 @@ def place_new_index(index_path, copy=True):
             pass
 
 
-def put_index(index_path, stream):
+def put_index(index_path, stream, warmup=None):
     """Replaces the index with a new version from a zip file that is
-    provided as file stream.
+    provided as file stream.  If a warmup function is provided it's
+    invoked with the path of the new version before it goes live.
     """
-    with place_new_index(index_path, copy=False) as new_idx:
+    with place_new_index(index_path, copy=False, warmup=warmup) as new_idx:
         with zipfile.ZipFile(stream, 'r') as zip:
             zip.extractall(new_idx)
+    # the uploaded index holds all sections
+    remove_shards(index_path)
 
 
 def zip_up_index(stream, base_dir):
@@ -144,17 +288,23 @@ def zip_up_index(stream, base_dir):
 
 
 def index_tree(config, index_zip=None, base_dir=None, index_path=None,
-               from_zip=None):
+               from_zip=None, copy=True, cache=None, warmup=None,
+               profiler=None):
+    """Indexes the sources of a config and yields an
+    :class:`~rigidsearch.progress.IndexEvent` for every step.
+    """
     if from_zip is not None:
         source_tmp = tempfile.mkdtemp()
         with zipfile.ZipFile(from_zip, 'r') as zip:
             zip.extractall(source_tmp)
             base_dir = source_tmp
     try:
-        indexer = TreeIndexer(config, base_dir)
-        for evt in indexer.index_tree(index_path, index_zip):
+        indexer = TreeIndexer(config, base_dir, cache=cache,
+                              profiler=profiler)
+        for evt in indexer.index_tree(index_path, index_zip, copy=copy,
+                                      warmup=warmup):
             yield evt
-        yield u'Done!'
+        yield IndexEvent('done', IndexStats.combine(indexer.stats))
     finally:
         if from_zip is not None:
             try:
@@ -163,11 +313,45 @@ def index_tree(config, index_zip=None, base_dir=None, index_path=None,
                 pass
 
 
+def get_own_texts(text, spans):
+    """Returns a dictionary that maps the spans of the sections of a page
+    to their text without the sections nested in them.  This way every
+    part of a page is indexed twice at most, once for the page and once
+    for the innermost section it is in.  The spans are sorted once and
+    their nesting is tracked on a stack.
+    """
+    children = {}
+    stack = []
+    for span in sorted(set(spans), key=lambda x: (x[0], -x[1])):
+        # sorted by start, so the top contains the span if it ends later
+        while stack and stack[-1][1] < span[1]:
+            stack.pop()
+        if stack:
+            children[stack[-1]].append(span)
+        children[span] = []
+        stack.append(span)
+
+    rv = {}
+    for span, nested in children.iteritems():
+        buf = []
+        pos = span[0]
+        for start, end in nested:
+            buf.append(text[pos:start])
+            pos = end
+        buf.append(text[pos:span[1]])
+        rv[span] = u'\n'.join(x.strip() for x in buf if x.strip())
+    return rv
+
+
 class IndexTransaction(object):
 
-    def __init__(self, index):
+    def __init__(self, index, stats=None):
         self._index = index
         self._writer = None
+        self._searcher = None
+        if stats is None:
+            stats = IndexStats()
+        self.stats = stats
 
     def _get_writer(self):
         rv = self._writer
@@ -175,69 +359,155 @@ class IndexTransaction(object):
             return rv
         raise RuntimeError('Tranaction was not started')
 
-    def index_document(self, processor, path, source, section='generic'):
-        buf = []
-        h = hashlib.sha1()
-        with open(source, 'rb') as f:
-            while 1:
-                chunk = f.read(16384)
-                if not chunk:
-                    break
-                h.update(chunk)
-                buf.append(chunk)
-            contents = ''.join(buf)
-
-        docs = processor.process_document(contents, path)
-        self.remove_document(path, section)
-        for doc in docs:
-            self._writer.add_document(
-                path=doc['path'],
-                title=doc['title'],
-                content=doc['title'] + '\n\n' + doc['text'],
-                section=unicode(section),
-                checksum=unicode(h.hexdigest()),
-                priority=doc['priority']
-            )
-
-            content_fn = self._index.get_content_filename(doc['path'], section)
+    def _get_searcher(self):
+        # opening a searcher reads every segment, so it is only done once
+        # per writer.  Deletions show up in it as they are made.
+        if self._searcher is None:
+            self._searcher = self._get_writer().searcher()
+        return self._searcher
+
+    def _close_searcher(self):
+        if self._searcher is not None:
+            self._searcher.close()
+            self._searcher = None
+
+    def index_document(self, processor, path, source, section='generic',
+                       cache=None, replace=True):
+        """Indexes a page and its sections.  Unless `replace` is disabled
+        for pages that are known to be new, the old version of the page is
+        removed first.
+        """
+        stats = self.stats
+        with stats.measure('hash'):
+            with open(source, 'rb') as f:
+                contents = f.read()
+            h = hashlib.sha1(contents)
+        stats.bytes += len(contents)
+
+        docs = None
+        if cache is not None:
+            cache_key = cache.make_key(h.hexdigest(), processor, path)
+            docs = cache.get(cache_key)
+        if docs is None:
+            with stats.measure('parse'):
+                tree = processor.parse_document(contents)
+            with stats.measure('extract'):
+                docs = processor.process_tree(tree, path)
+                # normalize once here so that excerpts can be built
+                # straight from the stored content at query time.
+                page, sub_docs = docs[0], docs[1:]
+                spans = [doc['span'] for doc in sub_docs if 'span' in doc]
+                page['text'], spans = normalize_text_spans(page['text'],
+                                                           spans)
+                spans = iter(spans)
+                for doc in sub_docs:
+                    if 'span' in doc:
+                        doc['span'] = next(spans)
+                    else:
+                        doc['text'] = normalize_text(doc['text'])
+            if cache is not None:
+                cache.set(cache_key, docs)
+
+        with stats.measure('write'):
+            if replace:
+                self.remove_document(path, section)
+            own_texts = get_own_texts(docs[0]['text'], [
+                tuple(doc['span']) for doc in docs if 'span' in doc])
+            for doc in docs:
+                span = doc.get('span')
+                if span is not None:
+                    span = tuple(span)
+                    text = own_texts[span]
+                else:
+                    text = doc['text']
+                self._writer.add_document(
+                    path=doc['path'],
+                    title=doc['title'],
+                    content=doc['title'] + '\n\n' + text,
+                    section=unicode(section),
+                    checksum=unicode(h.hexdigest()),
+                    priority=doc['priority'],
+                    span=span
+                )
+                # sections stored as spans have no content of their own
+                if span is not None:
+                    continue
+
+                content_fn = self._index.get_content_filename(
+                    doc['path'], section)
+                try:
+                    os.makedirs(os.path.dirname(content_fn))
+                except OSError:
+                    pass
+                with open(content_fn, 'wb') as f:
+                    f.write(doc['text'].encode('utf-8'))
+
+    def remove_document(self, path, section='generic'):
+        # the sub-documents of a page (path#id) are removed along with it.
+        # The section is checked on the stored fields, intersecting with
+        # the postings of the section would touch every page of it.
+        q = Or([Term('path', path), Prefix('path', path + u'#')])
+        section = unicode(section)
+        paths = set([path])
+        searcher = self._get_searcher()
+        for docnum in searcher.docs_for_query(q):
+            if self._writer.is_deleted(docnum):
+                continue
+            fields = searcher.stored_fields(docnum)
+            if fields['section'] != section:
+                continue
+            if fields.get('span') is None:
+                paths.add(fields['path'])
+            self._writer.delete_document(docnum)
+
+        for path in paths:
+            content_fn = self._index.get_content_filename(path, section)
             try:
-                os.makedirs(os.path.dirname(content_fn))
+                os.remove(content_fn)
             except OSError:
                 pass
-            with open(content_fn, 'wb') as f:
-                f.write(doc['text'].encode('utf-8'))
 
-    def remove_document(self, path, section='generic'):
-        self._writer.delete_by_query(And([
-            Term('path', path),
-            Term('section', unicode(section)),
-        ]))
+    def flush(self):
+        """Commits what was written so far and starts a new writer.  This
+        keeps the memory of long running transactions bounded.  Only small
+        segments are merged so that their number, and with it the cost of
+        looking up pages, stays low.
+        """
+        self._close_searcher()
+        with self.stats.measure('commit'):
+            self._get_writer().commit()
+        self._writer = self._open_writer()
 
-        content_fn = self._index.get_content_filename(path, section)
-        try:
-            os.remove(content_fn)
-        except OSError:
-            pass
+    def _open_writer(self):
+        writer = self._index.whoosh_index.writer()
+        # indexes from before sections were stored as spans lack the field
+        if 'span' not in writer.schema:
+            writer.add_field('span', STORED())
+        return writer
 
     def __enter__(self):
         if self._writer is not None:
             raise RuntimeError('Already entered transaction')
-        self._writer = self._index.whoosh_index.writer()
+        self._writer = self._open_writer()
         return self
 
     def __exit__(self, exc_type, exc_value, tb):
-        self._writer.commit()
+        self._close_searcher()
+        with self.stats.measure('commit'):
+            self._writer.commit()
 
 
 class Index(object):
 
-    def __init__(self, index_path, whoosh_index, schema):
+    def __init__(self, index_path, whoosh_index, schema, section=None):
         self.index_path = index_path
         self.whoosh_index = whoosh_index
         self.schema = schema
+        # if set, this is the shard that only holds this section
+        self.section = section
 
-    def transaction(self):
-        return IndexTransaction(self)
+    def transaction(self, stats=None):
+        return IndexTransaction(self, stats=stats)
 
     def iter(self, section=None):
         with self.whoosh_index.searcher() as searcher:
@@ -250,9 +520,28 @@ class Index(object):
                     'title': fields['title'],
                     'section': fields['section'],
                     'checksum': fields['checksum'],
-                    'priority': fields['priority']
+                    'priority': fields.get('priority', 0)
                 }
 
+    def iter_paths(self, reader, section):
+        """Yields ``(path, checksum)`` tuples of the pages (not their
+        sub-documents) of a section ordered by path.  The paths are read
+        from the term index so nothing but the current page is held in
+        memory.
+        """
+        section = unicode(section)
+        for term in reader.lexicon('path'):
+            path = term.decode('utf-8')
+            if '#' in path:
+                continue
+            for docnum in reader.postings('path', term).all_ids():
+                if reader.is_deleted(docnum):
+                    continue
+                fields = reader.stored_fields(docnum)
+                if fields['section'] == section:
+                    yield path, fields['checksum']
+                    break
+
     def get_content_filename(self, path, section):
         h = hashlib.sha1()
         h.update(path.encode('utf-8'))
@@ -261,11 +550,18 @@ class Index(object):
         fn = os.path.join(self.index_path, 'content', h.hexdigest())
         return fn
 
-    def get_content(self, path, section, normalize=True):
+    def get_content(self, path, section, normalize=False, span=None):
+        """Returns the stored text of a document.  Sections stored as a
+        span of the page text are looked up in the content of the page.
+        """
+        if span is not None:
+            path = path.split('#', 1)[0]
         fn = self.get_content_filename(path, section)
         try:
             with open(fn, 'rb') as f:
                 text = f.read().decode('utf-8')
+                if span is not None:
+                    text = text[span[0]:span[1]].strip()
                 if normalize:
                     text = normalize_text(text)
                 return text
@@ -273,54 +569,334 @@ class Index(object):
             if e.errno != errno.ENOENT:
                 raise
 
+    def get_sections(self):
+        with self.whoosh_index.searcher() as searcher:
+            return [x.decode('utf-8') for x in searcher.lexicon('section')]
+
+    def parse_query(self, query):
+        qp = MultifieldParser(['title', 'content'], self.schema)
+        return qp.parse(unicode(query))
+
+    def get_excerpt(self, hit, plain=False, maxchars=None):
+        text = self.get_content(hit['path'], hit['section'],
+                                span=hit.get('span'))
+        if text is not None:
+            if plain:
+                return make_plain_excerpt(text, maxchars)
+            return hit.highlights('content', text=text)
+
     def search(self, query, section=None, page=1, per_page=20,
                excerpt_fragmenter=None, excerpt_maxchars=None,
-               excerpt_surround=None):
-        qp = MultifieldParser(['title', 'content'], self.schema)
-        q = qp.parse(unicode(query))
+               excerpt_surround=None, time_limit=None, max_expansions=None):
+        deadline = None
+        if time_limit is not None:
+            deadline = time.time() + time_limit
+        q = self.parse_query(query)
         mf = sorting.MultiFacet()
         mf.add_field("priority", reverse=True)
 
-        if section is not None:
+        if section is not None and section != self.section:
             q = And([q, Term('section', unicode(section))])
 
-        def _make_item(hit):
-            text = self.get_content(hit['path'], hit['section'])
-            if text is not None:
-                excerpt = hit.highlights('content', text=text)
-            else:
-                excerpt = None
-            return {
-                'path': hit['path'],
-                'title': hit['title'],
-                'excerpt': excerpt,
-                'section': section,
-            }
-
         with self.whoosh_index.searcher() as searcher:
-            rv = searcher.search_page(q, page, sortedby=mf, pagelen=per_page)
-            frag, anal = make_fragmenter_and_analyzer(
-                excerpt_fragmenter, excerpt_maxchars, excerpt_surround)
-            rv.results.formatter = make_html_formatter()
-            if frag is not None:
-                rv.results.fragmenter = frag
-            if anal is not None:
-                rv.results.analyzer = anal
+            q, expansions_limited = limit_expansions(
+                q, searcher.reader(), max_expansions)
+            results, timed_out = collect_hits(
+                searcher, q, page * per_page, mf, deadline)
+            configure_highlighting(results, excerpt_fragmenter,
+                                   excerpt_maxchars, excerpt_surround)
+            rv = ResultsPage(results, page, per_page)
+            items, degraded = make_result_items(
+                ((self, x) for x in rv), deadline, excerpt_maxchars,
+                section=section)
             return {
-                'items': [_make_item(x) for x in rv.results],
+                'items': items,
                 'pages': rv.pagecount,
                 'page': page,
-                'per_page': per_page
+                'per_page': per_page,
+                'truncated': expansions_limited or timed_out or degraded,
             }
 
 
+class DeadlineCollector(WrappingCollector):
+    """Stops collecting with :class:`~whoosh.collectors.TimeLimit` once the
+    deadline has passed, the collected hits stay available.  Unlike the
+    time limit collector of whoosh this does not need a timer thread or a
+    signal, so it also works on worker threads and with gevent.
+    """
+
+    def __init__(self, child, deadline):
+        WrappingCollector.__init__(self, child)
+        self.deadline = deadline
+
+    def collect_matches(self):
+        child = self.child
+        deadline = self.deadline
+        for sub_docnum in child.matches():
+            if time.time() > deadline:
+                raise TimeLimit()
+            child.collect(sub_docnum)
+
+
+def collect_hits(searcher, q, limit, sortedby, deadline=None):
+    """Runs a query and returns ``(results, truncated)``.  If a deadline
+    is given and the search runs past it, the hits found so far are
+    returned and `truncated` is set.
+    """
+    collector = searcher.collector(limit=limit, sortedby=sortedby)
+    if deadline is not None:
+        collector = DeadlineCollector(collector, deadline)
+    try:
+        searcher.search_with_collector(q, collector)
+    except TimeLimit:
+        return collector.results(), True
+    return collector.results(), False
+
+
+def limit_expansions(q, reader, max_expansions=None):
+    """Replaces wildcard, prefix, range and fuzzy terms that expand to
+    more than `max_expansions` terms with their first `max_expansions`
+    terms.  Returns ``(query, limited)``.
+    """
+    if max_expansions is None:
+        return q, False
+    limited = []
+
+    def _limit(node):
+        if not isinstance(node, MultiTerm):
+            return node
+        terms = list(islice(node.expanded_terms(reader),
+                            max_expansions + 1))
+        if len(terms) <= max_expansions:
+            return node
+        limited.append(node)
+        field = reader.schema[terms[0][0]]
+        return Or([Term(fieldname, field.from_bytes(btext),
+                        boost=node.boost)
+                   for fieldname, btext in terms[:max_expansions]])
+
+    return q.accept(_limit), bool(limited)
+
+
+def configure_highlighting(results, excerpt_fragmenter=None,
+                           excerpt_maxchars=None, excerpt_surround=None):
+    frag, anal = make_fragmenter_and_analyzer(
+        excerpt_fragmenter, excerpt_maxchars, excerpt_surround)
+    results.formatter = make_html_formatter()
+    if frag is not None:
+        results.fragmenter = frag
+    if anal is not None:
+        results.analyzer = anal
+
+
+def list_sections(index_path):
+    """Returns all sections in the main index and its shards."""
+    rv = set(get_index(index_path).get_sections())
+    for shard_path in iter_shard_paths(index_path):
+        rv.update(get_index(shard_path).get_sections())
+    return sorted(rv)
+
+
+def get_combined_version(index_path):
+    """Returns a version string that changes whenever the main index or
+    any of the section shards change.
+    """
+    rv = [get_index_version(index_path) or '']
+    shards_path = os.path.join(index_path, 'sections')
+    try:
+        shards = sorted(os.listdir(shards_path))
+    except OSError:
+        shards = []
+    for name in shards:
+        rv.append(get_index_version(os.path.join(shards_path, name)) or '')
+    return '+'.join(rv)
+
+
+def parse_sections(values):
+    """Parses the section arguments of a search.  Each value can hold a
+    comma separated list of sections, ``*`` stands for all sections in
+    which case `None` is returned.
+    """
+    rv = []
+    for value in values:
+        for section in value.split(','):
+            section = section.strip()
+            if section == '*':
+                return None
+            if section and section not in rv:
+                rv.append(section)
+    return rv or ['generic']
+
+
+def search_sections(index_path, query, sections, **kwargs):
+    """Searches a list of sections (or all of them if `None` is given).
+    A single section is searched directly on its index, everything else
+    goes through :func:`federated_search`.
+    """
+    if sections is not None and len(sections) == 1:
+        return get_index(index_path, section=sections[0]).search(
+            query, sections[0], **kwargs)
+    return federated_search(index_path, query, sections, **kwargs)
+
+
+def count_unique_hits(searches):
+    """Counts the pages matched by a number of ``(searcher, query)``
+    pairs where identical pages in more than one section count once.
+    Only the checksums of paths that match more than once are loaded.
+    """
+    by_path = {}
+    for searcher, q in searches:
+        reader = searcher.reader()
+        paths = reader.column_reader('path')
+        for docnum in searcher.docs_for_query(q):
+            by_path.setdefault(paths[docnum], []).append((reader, docnum))
+    rv = 0
+    for docs in by_path.itervalues():
+        if len(docs) == 1:
+            rv += 1
+        else:
+            rv += len(set(reader.stored_fields(docnum)['checksum']
+                          for reader, docnum in docs))
+    return rv
+
+
+def federated_search(index_path, query, sections=None, page=1, per_page=20,
+                     excerpt_fragmenter=None, excerpt_maxchars=None,
+                     excerpt_surround=None, time_limit=None,
+                     max_expansions=None):
+    """Searches multiple sections at once (all of them if no sections are
+    given).  Sections that live in the same index are searched with a
+    single query, shards are searched concurrently.  Hits are merged by
+    priority and score and identical pages that show up in more than one
+    section are only returned once.
+    """
+    deadline = None
+    if time_limit is not None:
+        deadline = time.time() + time_limit
+    if sections is None:
+        sections = list_sections(index_path)
+
+    groups = OrderedDict()
+    for section in sections:
+        groups.setdefault(resolve_shard(index_path, section), []) \
+            .append(section)
+    indexes = [(get_index(index_path, section=secs[0]), secs)
+               for secs in groups.itervalues()]
+
+    mf = sorting.MultiFacet()
+    mf.add_field("priority", reverse=True)
+    mf.add_score()
+
+    def _search(index, secs, limit, rv):
+        try:
+            rv['searcher'] = searcher = index.whoosh_index.searcher()
+            q = index.parse_query(query)
+            if secs != [index.section]:
+                q = And([q, Or([Term('section', unicode(x))
+                                for x in secs])])
+            q, expansions_limited = limit_expansions(
+                q, searcher.reader(), max_expansions)
+            rv['query'] = q
+            results, timed_out = collect_hits(searcher, q, limit, mf,
+                                              deadline)
+            configure_highlighting(results, excerpt_fragmenter,
+                                   excerpt_maxchars, excerpt_surround)
+            rv['results'] = results
+            rv['truncated'] = expansions_limited or timed_out
+        except Exception:
+            rv['exc_info'] = sys.exc_info()
+
+    limit = page * per_page
+    searchers = []
+    try:
+        while 1:
+            runs = []
+            threads = []
+            for index, secs in indexes:
+                rv = {}
+                runs.append((index, rv))
+                t = threading.Thread(target=_search,
+                                     args=(index, secs, limit, rv))
+                t.start()
+                threads.append(t)
+            for t in threads:
+                t.join()
+            for index, rv in runs:
+                if 'searcher' in rv:
+                    searchers.append(rv['searcher'])
+            for index, rv in runs:
+                exc_info = rv.get('exc_info')
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+            results = [(index, rv['results']) for index, rv in runs]
+            truncated = any(rv['truncated'] for index, rv in runs)
+
+            # the sort keys are derived from the priority column and the
+            # score, so they can be compared across indexes.
+            hits = sorted((hit.score, idx, hit.rank, index, hit)
+                          for idx, (index, rv) in enumerate(results)
+                          for hit in rv)
+            seen = set()
+            merged = []
+            for _, _, _, index, hit in hits:
+                key = (hit['checksum'], hit['path'])
+                if key not in seen:
+                    seen.add(key)
+                    merged.append((index, hit))
+            duplicates = len(hits) - len(merged)
+            exhausted = all(rv.scored_length() == len(rv)
+                            for index, rv in results)
+
+            # duplicates pushed hits we need past the limit, try again
+            # with a bigger one.
+            if len(merged) >= page * per_page or exhausted or truncated:
+                break
+            for searcher in searchers:
+                searcher.close()
+            searchers = []
+            limit *= 2
+
+        if exhausted or len(sections) == 1:
+            total = sum(len(rv) for index, rv in results) - duplicates
+        elif truncated:
+            # counting every match would run past the deadline, the
+            # duplicates beyond the limit are not known.
+            total = max(sum(len(rv) for index, rv in results) - duplicates,
+                        len(merged))
+        else:
+            total = count_unique_hits((rv['searcher'], rv['query'])
+                                      for index, rv in runs)
+
+        items, degraded = make_result_items(
+            merged[(page - 1) * per_page:page * per_page], deadline,
+            excerpt_maxchars)
+        return {
+            'items': items,
+            'pages': (total + per_page - 1) // per_page,
+            'page': page,
+            'per_page': per_page,
+            'truncated': truncated or degraded,
+        }
+    finally:
+        for searcher in searchers:
+            searcher.close()
+
+
 class TreeIndexer(object):
+    hash_workers = 8
+    shard_workers = 4
+    batch_size = 1000
 
-    def __init__(self, config, base_dir=None):
+    def __init__(self, config, base_dir=None, cache=None, profiler=None):
         if base_dir is None:
             base_dir = os.getcwd()
         self.configurations = config['configurations']
+        self.sharded = config.get('sharded', False)
+        self.streaming = config.get('streaming', False)
         self.base_dir = base_dir
+        self.cache = cache
+        self.profiler = profiler
+        self.stats = []
 
     def iter_sources(self):
         for conf in self.configurations:
@@ -332,39 +908,161 @@ class TreeIndexer(object):
                 path = os.path.join(self.base_dir, d.pop('path', None))
                 yield section, path, d
 
+    def count_documents(self):
+        """Counts the documents of all sources.  The walk does not read
+        any file so it is cheap compared to the build, and it gives
+        progress reports a total before the documents are hashed.
+        """
+        walk = self.streaming and iter_sorted_documents or iter_documents
+        return sum(1 for section, path, config in self.iter_sources()
+                   for _ in walk(path, ignore=config.get('skip_docs')
+                                 or None))
+
+    def begin_source(self, section):
+        stats = IndexStats(section)
+        self.stats.append(stats)
+        return stats
+
+    def get_source_indexer(self):
+        if self.streaming:
+            rv = self.index_source_streaming
+        else:
+            rv = self.index_source
+        if self.profiler is None:
+            return rv
+
+        def _profiled(index, section, path, config):
+            with self.profiler.profile('index-%s' % section,
+                                       deterministic=True):
+                for evt in rv(index, section, path, config):
+                    yield evt
+        return _profiled
+
     def index_source(self, index, section, path, config):
         processor = Processor.from_config(config)
-        all_docs = find_all_documents(
-            path, ignore=config.get('skip_docs') or None)
+        checksums = dict((doc['path'], doc['checksum'])
+                         for doc in index.iter(section=section)
+                         if '#' not in doc['path'])
+        stats = self.begin_source(section)
+
+        # Only documents already in the index need to be hashed to find
+        # out if they changed, everything else is indexed as soon as the
+        # walk discovers it.
+        def _iter_candidates():
+            for doc_path, source_file in iter_documents(
+                    path, ignore=config.get('skip_docs') or None):
+                if doc_path in checksums:
+                    yield (doc_path, source_file), source_file
+                else:
+                    yield (doc_path, source_file), None
 
-        to_delete = set()
-        to_index = {}
         seen = set()
+        with index.transaction(stats=stats) as t:
+            for (doc_path, source_file), checksum in iter_checksums(
+                    _iter_candidates(), workers=self.hash_workers,
+                    stats=stats):
+                seen.add(doc_path)
+                stats.examined += 1
+                if checksum is not None and \
+                   checksum == checksums[doc_path]:
+                    continue
+                stats.found += 1
+                yield IndexEvent('index', stats, doc_path)
+                t.index_document(processor, doc_path, source_file,
+                                 section=section, cache=self.cache,
+                                 replace=doc_path in checksums)
+                stats.indexed += 1
+
+            to_delete = [x for x in checksums if x not in seen]
+            stats.found += len(to_delete)
+            for doc_path in to_delete:
+                yield IndexEvent('remove', stats, doc_path)
+                t.remove_document(doc_path, section=section)
+                stats.removed += 1
+
+        stats.finished = time.time()
+        yield IndexEvent('section', stats)
+
+    def index_source_streaming(self, index, section, path, config):
+        """Like :meth:`index_source` but with memory that does not grow
+        with the size of the tree.  The sorted walk of the tree is merged
+        with the sorted paths in the index, the changes are written in
+        batches of `batch_size` documents which are committed as they
+        are done.
+        """
+        processor = Processor.from_config(config)
+        stats = self.begin_source(section)
+
+        searcher = index.whoosh_index.searcher()
+        try:
+            reader = searcher.reader()
 
-        for doc in index.iter(section=section):
-            source_file = all_docs.get(doc['path'])
-            if source_file is None:
-                to_delete.add(doc['path'])
-            elif file_changed(source_file, doc['checksum']):
-                to_index[doc['path']] = source_file
-            seen.add(doc['path'])
-
-        for path, source_file in all_docs.iteritems():
-            if path not in seen:
-                to_index[path] = source_file
-
-        with index.transaction() as t:
-            for path, source_file in to_index.iteritems():
-                yield 'Indexing %s (%s)' % (path, section)
-                t.index_document(processor, path, source_file, section=section)
-            for path in to_delete:
-                yield 'Removing %s (%s)' % (path, section)
-                t.remove_document(path, section=section)
+            # yields ``(path, source_file, old_checksum)`` for every page
+            # that has to be looked at.  New pages come without an old
+            # checksum and pages without source file have to be removed.
+            def _merge_join():
+                documents = iter_sorted_documents(
+                    path, ignore=config.get('skip_docs') or None)
+                indexed = index.iter_paths(reader, section)
+                doc = next(documents, None)
+                indexed_doc = next(indexed, None)
+                while doc is not None or indexed_doc is not None:
+                    if indexed_doc is None or \
+                       (doc is not None and doc[0] < indexed_doc[0]):
+                        yield doc[0], doc[1], None
+                        doc = next(documents, None)
+                    elif doc is None or doc[0] > indexed_doc[0]:
+                        yield indexed_doc[0], None, indexed_doc[1]
+                        indexed_doc = next(indexed, None)
+                    else:
+                        yield doc[0], doc[1], indexed_doc[1]
+                        doc = next(documents, None)
+                        indexed_doc = next(indexed, None)
+
+            def _iter_candidates():
+                for item in _merge_join():
+                    doc_path, source_file, old_checksum = item
+                    if source_file is not None and old_checksum is not None:
+                        yield item, source_file
+                    else:
+                        yield item, None
+
+            pending = 0
+            with index.transaction(stats=stats) as t:
+                for (doc_path, source_file, old_checksum), checksum in \
+                        iter_checksums(_iter_candidates(),
+                                       workers=self.hash_workers,
+                                       stats=stats):
+                    if source_file is not None:
+                        stats.examined += 1
+                    if checksum is not None and checksum == old_checksum:
+                        continue
+                    stats.found += 1
+                    if source_file is None:
+                        yield IndexEvent('remove', stats, doc_path)
+                        t.remove_document(doc_path, section=section)
+                        stats.removed += 1
+                    else:
+                        yield IndexEvent('index', stats, doc_path)
+                        t.index_document(processor, doc_path, source_file,
+                                         section=section, cache=self.cache,
+                                         replace=old_checksum is not None)
+                        stats.indexed += 1
+                    pending += 1
+                    if pending >= self.batch_size:
+                        t.flush()
+                        pending = 0
+        finally:
+            searcher.close()
+
+        stats.finished = time.time()
+        yield IndexEvent('section', stats)
 
     @contextmanager
-    def _process(self, index_path, index_zip):
+    def _process(self, index_path, index_zip, copy=True, warmup=None):
         if index_zip is None:
-            with place_new_index(index_path, copy=True) as path:
+            with place_new_index(index_path, copy=copy,
+                                 warmup=warmup) as path:
                 yield path
             return
         try:
@@ -379,9 +1077,81 @@ class TreeIndexer(object):
             except (OSError, IOError):
                 pass
 
-    def index_tree(self, index_path=None, index_zip=None):
-        with self._process(index_path, index_zip) as load_path:
-            index = get_index(load_path, resolve_cur=False)
-            for section, path, config in self.iter_sources():
-                for evt in self.index_source(index, section, path, config):
-                    yield evt
+    def index_tree(self, index_path=None, index_zip=None, copy=True,
+                   warmup=None):
+        yield IndexEvent('discover', IndexStats(),
+                         total=self.count_documents())
+        if self.sharded:
+            if index_zip is not None:
+                raise ValueError('Sharded indexes cannot be written to '
+                                 'a zip file.')
+            for evt in self.index_shards(index_path, copy, warmup):
+                yield evt
+        else:
+            with self._process(index_path, index_zip, copy=copy,
+                               warmup=warmup) as load_path:
+                index = get_index(load_path, resolve_cur=False)
+                for section, path, config in self.iter_sources():
+                    for evt in self.get_source_indexer()(
+                            index, section, path, config):
+                        yield evt
+            # shards of earlier sharded builds would hide the new index
+            if index_zip is None:
+                remove_shards(index_path)
+        if self.cache is not None:
+            self.cache.prune()
+
+    def index_shards(self, index_path, copy=True, warmup=None):
+        """Builds every section into its own shard.  Shards are built in
+        parallel and each of them goes live as soon as it's done.
+        """
+        sources = OrderedDict()
+        for section, path, config in self.iter_sources():
+            sources.setdefault(section, []).append((path, config))
+
+        pending = deque(sources)
+        events = NativeQueue()
+        done = object()
+
+        def _build():
+            try:
+                while 1:
+                    try:
+                        section = pending.popleft()
+                    except IndexError:
+                        break
+                    shard_path = get_shard_path(index_path, section)
+                    with place_new_index(shard_path, copy=copy,
+                                         warmup=warmup) as load_path:
+                        index = get_index(load_path, resolve_cur=False)
+                        for path, config in sources[section]:
+                            for evt in self.get_source_indexer()(
+                                    index, section, path, config):
+                                events.put((evt, None))
+            except Exception:
+                events.put((None, sys.exc_info()))
+            finally:
+                events.put(done)
+
+        running = max(1, min(self.shard_workers, len(sources)))
+        for _ in xrange(running):
+            start_native_thread(_build)
+
+        while running:
+            rv = events.get()
+            if rv is done:
+                running -= 1
+                continue
+            evt, exc_info = rv
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            yield evt
+
+        # the sections live in shards now, an empty main index makes sure
+        # that no section is served from an earlier unsharded build
+        with place_new_index(index_path, copy=False,
+                             warmup=warmup) as load_path:
+            get_index(load_path, resolve_cur=False)
+
+        # sections that are gone from the config lose their shards
+        remove_shards(index_path, keep=sources)
@@ -1,11 +1,106 @@
 import re
+import zlib
+import json
+import threading
+from bisect import bisect_right
+from Queue import Full
+from collections import OrderedDict, deque
 from cStringIO import StringIO as BytesIO
 from datetime import timedelta
 from functools import update_wrapper
 from flask import make_response, current_app, request
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# whitespace runs with two or more newlines, runs with exactly one newline
+# and runs without a newline that are anything but a single space.
+_paragraph_ws_re = re.compile(r'[^\S\n]*\n[^\S\n]*\n\s*')
+_line_ws_re = re.compile(r'[^\S\n]*\n[^\S\n]*')
+_inline_ws_re = re.compile(r'[^\S\n]{2,}|[^\S\n ]')
+
+def get_native(name):
+    """Returns a function of the `thread` module as it was before gevent's
+    monkey patching.  Threads started with the original functions are real
+    threads that keep running while a greenlet hogs the CPU.
+    """
+    try:
+        from gevent import monkey
+    except ImportError:
+        import thread
+        return getattr(thread, name)
+    return monkey.get_original('thread', name)
+
+
+def start_native_thread(func, args=()):
+    return get_native('start_new_thread')(func, args)
+
+
+class NativeQueue(object):
+    """A FIFO queue for native threads.  The standard queue is built on the
+    locks of the threading module which gevent's monkey patching turns
+    into greenlet locks, so this one only uses native locks.  Blocking
+    calls block the whole thread and must not be made from a greenlet,
+    ``put_nowait`` is safe to use anywhere.
+    """
+
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self._items = deque()
+        self._unfinished = 0
+        self._allocate_lock = get_native('allocate_lock')
+        self._mutex = self._allocate_lock()
+        self._waiters = deque()
+
+    def _wait(self):
+        # called with the mutex held, returns after the next change
+        waiter = self._allocate_lock()
+        waiter.acquire()
+        self._waiters.append(waiter)
+        self._mutex.release()
+        try:
+            waiter.acquire()
+        finally:
+            self._mutex.acquire()
+
+    def _notify(self):
+        while self._waiters:
+            self._waiters.popleft().release()
+
+    def put(self, item, block=True):
+        with self._mutex:
+            while self.maxsize > 0 and len(self._items) >= self.maxsize:
+                if not block:
+                    raise Full()
+                self._wait()
+            self._items.append(item)
+            self._unfinished += 1
+            self._notify()
+
+    def put_nowait(self, item):
+        self.put(item, block=False)
+
+    def get(self):
+        with self._mutex:
+            while not self._items:
+                self._wait()
+            item = self._items.popleft()
+            self._notify()
+            return item
+
+    def task_done(self):
+        with self._mutex:
+            self._unfinished -= 1
+            self._notify()
+
+    def join(self):
+        with self._mutex:
+            while self._unfinished:
+                self._wait()
 
-_ws_re = re.compile(r'(\s+)')
 
 def chop_tail(base, tail):
     if not base.endswith(tail):
@@ -14,39 +109,94 @@ def chop_tail(base, tail):
 
 
 def normalize_text(text):
-    def _handle_match(match):
-        ws = match.group()
-        nl = ws.count('\n')
-        if nl >= 2:
-            return u'\n\n'
-        elif nl == 1:
-            return u'\n'
-        return u' '
-    return _ws_re.sub(_handle_match, text).strip('\n')
+    """Collapses whitespace runs: runs with two or more newlines become a
+    paragraph break, runs with one newline a line break and all others a
+    single space.
+    """
+    text = _paragraph_ws_re.sub(u'\n\n', text)
+    text = _line_ws_re.sub(u'\n', text)
+    text = _inline_ws_re.sub(u' ', text)
+    return text.strip('\n')
+
+
+def _sub_with_offsets(regex, repl, text, offsets):
+    # offsets within a replaced run move to the start of its replacement
+    buf = []
+    starts = []
+    moves = []
+    last = 0
+    new_pos = 0
+    for match in regex.finditer(text):
+        buf.append(text[last:match.start()])
+        new_pos += match.start() - last
+        starts.append(match.start())
+        moves.append((match.end(), new_pos))
+        buf.append(repl)
+        new_pos += len(repl)
+        last = match.end()
+    buf.append(text[last:])
+
+    rv = []
+    for offset in offsets:
+        idx = bisect_right(starts, offset) - 1
+        if idx < 0:
+            rv.append(offset)
+            continue
+        end, pos = moves[idx]
+        if offset < end:
+            rv.append(pos)
+        else:
+            rv.append(pos + len(repl) + offset - end)
+    return u''.join(buf), rv
+
+
+def normalize_text_spans(text, spans):
+    """Like :func:`normalize_text` but also maps a list of ``(start,
+    end)`` spans into the text to the normalized text.
+    """
+    offsets = [x for span in spans for x in span]
+    text, offsets = _sub_with_offsets(_paragraph_ws_re, u'\n\n', text,
+                                      offsets)
+    text, offsets = _sub_with_offsets(_line_ws_re, u'\n', text, offsets)
+    text, offsets = _sub_with_offsets(_inline_ws_re, u' ', text, offsets)
+    skip = len(text) - len(text.lstrip('\n'))
+    text = text.strip('\n')
+    offsets = [max(0, min(len(text), x - skip)) for x in offsets]
+    return text, [tuple(offsets[idx:idx + 2])
+                  for idx in xrange(0, len(offsets), 2)]
 
 
 def cors(origin=None, methods=None, headers=None, max_age=21600,
-         attach_to_all=True, automatic_options=True):
+         attach_to_all=True, automatic_options=True, expose_headers=None):
     if methods is not None:
         methods = ', '.join(sorted(x.upper() for x in methods))
     if headers is not None and not isinstance(headers, basestring):
         headers = ', '.join(x.upper() for x in headers)
+    if expose_headers is not None and \
+       not isinstance(expose_headers, basestring):
+        expose_headers = ', '.join(expose_headers)
     if not isinstance(origin, basestring):
         origin = ', '.join(origin or ('*',))
     if isinstance(max_age, timedelta):
         max_age = max_age.total_seconds()
 
+    # the allowed methods of an endpoint never change, so they are only
+    # looked up once from the url map.
+    allowed_methods = []
+
     def get_methods():
         if methods is not None:
             return methods
-
-        options_resp = current_app.make_default_options_response()
-        return options_resp.headers['allow']
+        if not allowed_methods:
+            options_resp = current_app.make_default_options_response()
+            allowed_methods.append(options_resp.headers['allow'])
+        return allowed_methods[0]
 
     def decorator(f):
         def wrapped_function(*args, **kwargs):
             if automatic_options and request.method == 'OPTIONS':
-                resp = current_app.make_default_options_response()
+                resp = current_app.response_class()
+                resp.headers['Allow'] = get_methods()
             else:
                 resp = make_response(f(*args, **kwargs))
             if not attach_to_all and request.method != 'OPTIONS':
@@ -59,6 +209,8 @@ def cors(origin=None, methods=None, headers=None, max_age=21600,
             h['Access-Control-Max-Age'] = str(max_age)
             if headers is not None:
                 h['Access-Control-Allow-Headers'] = headers
+            if expose_headers is not None:
+                h['Access-Control-Expose-Headers'] = expose_headers
             return resp
 
         f.provide_automatic_options = False
@@ -71,3 +223,52 @@ def release_file(request, name):
     rv = f.stream
     f.stream = BytesIO()
     return rv
+
+
+def dump_json(obj):
+    """Serializes an object into compact json as bytes."""
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def get_supported_encodings():
+    rv = ['gzip']
+    if brotli is not None:
+        rv.insert(0, 'br')
+    return rv
+
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=5)
+    elif encoding == 'gzip':
+        c = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return c.compress(data) + c.flush()
+    return data
+
+
+class LRUCache(object):
+    """A simple thread safe cache that holds up to `max_size` items."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            rv = self._items.pop(key, None)
+            if rv is not None:
+                self._items[key] = rv
+            return rv
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
@@ -0,0 +1,143 @@
+import os
+import threading
+from collections import deque
+
+from flask import current_app
+
+from rigidsearch.search import get_index, get_index_path, \
+     get_index_version, iter_shard_paths
+
+
+_warmer_lock = threading.Lock()
+
+
+def parse_warmup_queries(value):
+    """Parses the configured warmup queries.  They are either given as a
+    list of ``(section, query)`` tuples or as a comma separated string of
+    ``section:query`` items.  Without a section all sections are searched.
+    """
+    if not value:
+        return []
+    if isinstance(value, basestring):
+        value = [x.strip() for x in value.split(',')]
+    rv = []
+    for item in value:
+        if isinstance(item, basestring):
+            if not item:
+                continue
+            section, _, query = item.rpartition(':')
+            item = (section or None, query)
+        rv.append(tuple(item))
+    return rv
+
+
+def warm_index(index_path, queries=()):
+    """Pulls an index version into the OS page cache and runs the given
+    queries against it so that the first real searches do not hit a cold
+    index.
+    """
+    for dirpath, dirnames, filenames in os.walk(index_path):
+        for filename in filenames:
+            try:
+                with open(os.path.join(dirpath, filename), 'rb') as f:
+                    while f.read(65536):
+                        pass
+            except (OSError, IOError):
+                pass
+
+    index = get_index(index_path, resolve_cur=False)
+    for section, query in queries:
+        index.search(query, section)
+
+
+class Warmer(object):
+    """Keeps track of which versions of the index and its shards this
+    process has warmed up and of the most recent queries so they can be
+    replayed against new versions.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.queries = parse_warmup_queries(
+            app.config.get('SEARCH_WARMUP_QUERIES'))
+        self.recent_queries = deque(
+            maxlen=int(app.config['SEARCH_WARMUP_RECENT_QUERIES']))
+        # maps the paths of the index and the shards to the version
+        # that was warmed up last
+        self.warmed_versions = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def record_query(self, query, section):
+        if query and self.recent_queries.maxlen:
+            self.recent_queries.append((section, query))
+
+    def get_queries(self):
+        rv = list(self.queries)
+        seen = set(rv)
+        for item in list(self.recent_queries):
+            if item not in seen:
+                seen.add(item)
+                rv.append(item)
+        return rv
+
+    def warm(self, path):
+        """Warms up the index version at the given path."""
+        warm_index(path, self.get_queries())
+        path = path.rstrip('/')
+        self.warmed_versions[os.path.dirname(path)] = \
+            os.path.basename(path)
+
+    def get_cold_versions(self, index_path=None):
+        """Returns the paths of the live versions of the index and its
+        shards that were not warmed up yet.
+        """
+        index_path = get_index_path(index_path, self.app).rstrip('/')
+        rv = []
+        for path in [index_path] + list(iter_shard_paths(index_path)):
+            version = get_index_version(path)
+            if version is not None and \
+               version != self.warmed_versions.get(path):
+                rv.append(os.path.join(path, version))
+        return rv
+
+    def is_warm(self, index_path=None):
+        index_path = get_index_path(index_path, self.app)
+        return get_index_version(index_path) is not None and \
+            not self.get_cold_versions(index_path)
+
+    def ensure_warm(self, index_path=None):
+        """Returns `True` if the live versions of the index and all of
+        its shards are warmed up.  Otherwise a warmup is started in the
+        background unless one is already running.
+        """
+        index_path = get_index_path(index_path, self.app)
+        if get_index_version(index_path) is None:
+            return False
+        paths = self.get_cold_versions(index_path)
+        if not paths:
+            return True
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._warm_in_background, args=(paths,))
+                self._thread.daemon = True
+                self._thread.start()
+        return False
+
+    def _warm_in_background(self, paths):
+        for path in paths:
+            try:
+                self.warm(path)
+            except Exception:
+                self.app.logger.exception('Warmup of %s failed', path)
+
+
+def get_warmer(app=None):
+    if app is None:
+        app = current_app._get_current_object()
+    with _warmer_lock:
+        rv = app.extensions.get('rigidsearch_warmer')
+        if rv is None:
+            rv = app.extensions['rigidsearch_warmer'] = Warmer(app)
+        return rv
@@ -22,6 +22,7 @@ setup(
         'cssselect',
         'raven',
         'blinker',
+        'scandir; python_version < "3.5"',
     ],
     extras_require={
         'server': ['gunicorn', 'gevent'],
@@ -0,0 +1,309 @@
+import os
+import json
+import zipfile
+from cStringIO import StringIO
+
+
+def make_app(index_path):
+    from rigidsearch.app import create_app
+    return create_app(config={
+        'SEARCH_INDEX_PATH': index_path,
+        'SEARCH_INDEX_SECRET': 'secret',
+        'TESTING': True,
+    })
+
+
+def zip_project(project_path):
+    rv = StringIO()
+    with zipfile.ZipFile(rv, 'w') as zip:
+        for dirpath, dirnames, filenames in os.walk(project_path):
+            for name in filenames:
+                if name.endswith('.html'):
+                    path = os.path.join(dirpath, name)
+                    zip.write(path, path[len(project_path) + 1:])
+    rv.seek(0)
+    return rv
+
+
+def upload_sources(client, project_path):
+    with open(os.path.join(project_path, 'config.json'), 'rb') as f:
+        config = f.read()
+    return client.put('/api/index/sources', data={
+        'secret': 'secret',
+        'config': (StringIO(config), 'config.json'),
+        'archive': (zip_project(project_path), 'archive.zip'),
+    })
+
+
+def test_background_build(index_path, project_path):
+    from rigidsearch.jobs import get_job_manager
+
+    app = make_app(index_path)
+    client = app.test_client()
+
+    rv = upload_sources(client, project_path)
+    assert rv.status_code == 202
+    job = json.loads(rv.data)
+    assert job['status'] in ('queued', 'running', 'done')
+
+    get_job_manager(app).join()
+
+    rv = client.get('/api/index/jobs/%s' % job['id'])
+    assert rv.status_code == 200
+    info = json.loads(rv.data)
+    assert info['status'] == 'done'
+    assert info['processed'] == info['examined'] == info['total'] == 2
+    assert info['eta'] is None
+
+    rv = client.get('/api/search?q=totally&section=a')
+    assert [x['path'] for x in json.loads(rv.data)['items']] == [u'index']
+
+    rv = client.get('/api/index/jobs/doesnotexist')
+    assert rv.status_code == 404
+
+
+def test_builds_are_serialized(index_path, project_path):
+    import time
+    from rigidsearch.jobs import get_job_manager
+
+    app = make_app(index_path)
+    client = app.test_client()
+    manager = get_job_manager(app)
+
+    # a build of another process holds the lock
+    with manager.build_lock():
+        job = json.loads(upload_sources(client, project_path).data)
+        time.sleep(0.2)
+        info = json.loads(client.get('/api/index/jobs/%s' % job['id']).data)
+        assert info['status'] == 'queued'
+
+    manager.join()
+    info = json.loads(client.get('/api/index/jobs/%s' % job['id']).data)
+    assert info['status'] == 'done'
+
+
+def test_search_caching(index_path):
+    app = make_app(index_path)
+    client = app.test_client()
+
+    rv = client.get('/api/search?q=foo&section=a')
+    assert rv.status_code == 200
+    etag = rv.headers['ETag']
+    assert rv.headers['X-Rigidsearch-Index-Version']
+    assert 'max-age=60' in rv.headers['Cache-Control']
+
+    rv = client.get('/api/search?q=foo&section=a',
+                    headers={'If-None-Match': etag})
+    assert rv.status_code == 304
+    assert rv.data == ''
+
+    rv = client.get('/api/search?q=bar&section=a',
+                    headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+
+    rv = client.open('/api/search', method='OPTIONS')
+    assert rv.status_code == 200
+    assert rv.headers['Access-Control-Max-Age'] == '21600'
+
+
+def test_search_compression(index_path, project_path):
+    import gzip
+    from rigidsearch.jobs import get_job_manager
+
+    app = make_app(index_path)
+    app.config['SEARCH_COMPRESS_MIN_SIZE'] = '0'
+    client = app.test_client()
+    upload_sources(client, project_path)
+    get_job_manager(app).join()
+
+    rv = client.get('/api/search?q=totally&section=a')
+    assert 'Content-Encoding' not in rv.headers
+    assert '"items":[' in rv.data
+    data = json.loads(rv.data)
+    assert data['items'][0]['path'] == u'index'
+
+    rv = client.get('/api/search?q=totally&section=a',
+                    headers={'Accept-Encoding': 'gzip'})
+    assert rv.headers['Content-Encoding'] == 'gzip'
+    assert rv.headers['Vary'] == 'Accept-Encoding'
+    assert json.loads(gzip.GzipFile(fileobj=StringIO(rv.data)).read()) == \
+        data
+
+
+def test_health_and_ready(index_path, project_path):
+    from rigidsearch.jobs import get_job_manager
+    from rigidsearch.warmup import get_warmer
+
+    app = make_app(index_path)
+    app.config['SEARCH_WARMUP_QUERIES'] = 'a:totally'
+    client = app.test_client()
+    upload_sources(client, project_path)
+    get_job_manager(app).join()
+
+    # the build warmed the new version before it went live
+    assert get_warmer(app).queries == [('a', 'totally')]
+    rv = client.get('/api/health')
+    info = json.loads(rv.data)
+    assert info['warm'] is True
+    assert info['version']
+
+    rv = client.get('/api/ready')
+    assert rv.status_code == 200
+    assert json.loads(rv.data)['version'] == info['version']
+
+    get_warmer(app).warmed_versions.clear()
+    rv = client.get('/api/ready')
+    assert rv.status_code == 503
+    get_warmer(app)._thread.join()
+    rv = client.get('/api/ready')
+    assert rv.status_code == 200
+
+
+def test_ready_tracks_shards(index_path, project_path):
+    from rigidsearch.search import index_tree
+    from rigidsearch.warmup import get_warmer
+
+    app = make_app(index_path)
+    client = app.test_client()
+    with open(os.path.join(project_path, 'config.json'), 'rb') as f:
+        cfg = json.load(f)
+    cfg['sharded'] = True
+    warmer = get_warmer(app)
+    list(index_tree(cfg, index_path=index_path, base_dir=project_path,
+                    warmup=warmer.warm))
+    client.get('/api/search?q=foo')
+    warmer.warm(os.path.join(index_path, os.readlink(
+        os.path.join(index_path, 'cur'))))
+    assert client.get('/api/ready').status_code == 200
+
+    # a shard that was not warmed up makes the server not ready
+    shard_path = os.path.join(index_path, 'sections', 'b')
+    del warmer.warmed_versions[shard_path]
+    assert client.get('/api/ready').status_code == 503
+    warmer._thread.join()
+    assert client.get('/api/ready').status_code == 200
+
+
+def test_query_log_replay(index_path, project_path):
+    from rigidsearch.jobs import get_job_manager
+    from rigidsearch.querylog import get_query_log, iter_query_log, \
+         replay_queries
+
+    log_path = os.path.join(index_path, 'queries.log')
+    app = make_app(index_path)
+    app.config['SEARCH_QUERY_LOG_PATH'] = log_path
+    client = app.test_client()
+    upload_sources(client, project_path)
+    get_job_manager(app).join()
+
+    client.get('/api/search?q=totally&section=a')
+    client.get('/api/search?q=tot*&section=b&per_page=5')
+    get_query_log(app).flush()
+
+    # every process logs into its own file
+    assert get_query_log(app).filename == os.path.join(
+        index_path, 'queries.%d.log' % os.getpid())
+    with open(get_query_log(app).filename) as f:
+        entries = list(iter_query_log(f))
+    assert [(x['q'], x['section']) for x in entries] == [
+        ('totally', 'a'), ('tot*', 'b')]
+    assert entries[1]['per_page'] == '5'
+
+    rv = replay_queries(index_path, entries * 3, concurrency=2)
+    assert not rv['failures']
+    assert sorted((k, len(v)) for k, v in rv['latencies'].items()) == [
+        ('single-term', 3), ('wildcard', 3)]
+
+
+def test_federated_search(index_path, project_path):
+    from rigidsearch.jobs import get_job_manager
+
+    app = make_app(index_path)
+    client = app.test_client()
+    upload_sources(client, project_path)
+    get_job_manager(app).join()
+
+    # ver-a and ver-b hold the same page, it's only returned once
+    for section in '*', 'a,b':
+        rv = client.get('/api/search?q=totally&section=' + section)
+        data = json.loads(rv.data)
+        assert [(x['path'], x['section']) for x in data['items']] == \
+            [(u'index', u'a')]
+        assert data['pages'] == 1
+
+    rv = client.get('/api/search?q=totally&section=b&section=c')
+    data = json.loads(rv.data)
+    assert [(x['path'], x['section']) for x in data['items']] == \
+        [(u'index', u'b')]
+
+
+def test_search_profiling(index_path):
+    app = make_app(index_path)
+    app.config['SEARCH_PROFILE_PATH'] = os.path.join(index_path, 'profiles')
+    client = app.test_client()
+    admin = {'X-Rigidsearch-Secret': 'secret'}
+
+    assert client.get('/api/search?q=foo&profile=1').status_code == 403
+    assert client.get('/api/search?q=foo&profile=1&secret=secret') \
+        .status_code == 403
+    rv = client.get('/api/search?q=foo&profile=1', headers=admin)
+    assert rv.status_code == 200
+    assert 'no-store' in rv.headers['Cache-Control']
+    # profiled requests bypass the response cache
+    client.get('/api/search?q=foo&profile=1', headers=admin)
+    assert len(app.extensions['rigidsearch_responses']) == 0
+
+    assert client.get('/api/profiles').status_code == 403
+    profiles = json.loads(client.get('/api/profiles', headers=admin).data)
+    assert len(profiles['profiles']) == 2
+    assert profiles['profiles'][0].endswith('.pstats')
+
+    rv = client.get('/api/profiles/%s' % profiles['profiles'][0],
+                    headers=admin)
+    assert rv.status_code == 200
+    assert rv.data
+
+    app.config['SEARCH_PROFILE_THRESHOLD'] = '0'
+    app.extensions.pop('rigidsearch_profiler')
+    client.get('/api/search?q=bar')
+    profiles = json.loads(client.get('/api/profiles', headers=admin).data)
+    assert len([x for x in profiles['profiles']
+                if x.endswith('.folded')]) == 1
+
+
+def test_search_guards(index_path, project_path):
+    from rigidsearch.jobs import get_job_manager
+
+    app = make_app(index_path)
+    app.config['SEARCH_MAX_PER_PAGE'] = '1'
+    client = app.test_client()
+    upload_sources(client, project_path)
+    get_job_manager(app).join()
+
+    rv = client.get('/api/search?q=*o*&section=a&per_page=10000')
+    data = json.loads(rv.data)
+    assert data['per_page'] == 1
+    assert len(data['items']) == 1
+    assert not data['truncated']
+    assert rv.headers['ETag']
+
+    # prefix queries expanding to too many terms are cut down
+    app.config['SEARCH_MAX_TERM_EXPANSIONS'] = '1'
+    rv = client.get('/api/search?q=*o*&section=b')
+    assert json.loads(rv.data)['truncated']
+    assert 'no-store' in rv.headers['Cache-Control']
+    assert 'ETag' not in rv.headers
+
+    # out of time partial results are returned
+    app.config['SEARCH_TIME_LIMIT'] = '0.000001'
+    rv = client.get('/api/search?q=totally&section=a,b')
+    data = json.loads(rv.data)
+    assert data['truncated']
+    assert data['items'] == []
+
+
+def test_plain_excerpt():
+    from rigidsearch.search import make_plain_excerpt
+    assert make_plain_excerpt(u'a <b> c d', 7) == u'a &lt;b&gt;\u2026'
+    assert make_plain_excerpt(u'short') == u'short'
+    assert make_plain_excerpt(u' x', 1) == u'\u2026'
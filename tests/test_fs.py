@@ -0,0 +1,46 @@
+import os
+
+
+def test_find_all_documents(project_path):
+    from rigidsearch.fs import find_all_documents
+
+    docs = find_all_documents(project_path)
+    assert docs == {
+        u'ver-a': os.path.join(project_path, 'ver-a', 'index.html'),
+        u'ver-b': os.path.join(project_path, 'ver-b', 'index.html'),
+    }
+
+
+def test_iter_checksums(project_path):
+    from rigidsearch.fs import iter_documents, iter_checksums, \
+         get_file_checksum
+
+    items = list(iter_documents(project_path))
+    items.append(('missing', None))
+    rv = dict(iter_checksums(iter(items), workers=2))
+    assert rv == {
+        u'ver-a': get_file_checksum(items[0][1]),
+        u'ver-b': get_file_checksum(items[1][1]),
+        'missing': None,
+    }
+
+
+def test_symlink_loops_are_not_followed(tmpdir):
+    from rigidsearch.fs import iter_documents, iter_sorted_documents
+
+    tmpdir.join('docs', 'index.html').write('', ensure=True)
+    tmpdir.join('docs', 'loop').mksymlinkto(tmpdir.join('docs'))
+    base = str(tmpdir.join('docs'))
+    assert [x[0] for x in iter_documents(base)] == [u'index']
+    assert [x[0] for x in iter_sorted_documents(base)] == [u'index']
+
+
+def test_paths_are_only_yielded_once(tmpdir):
+    from rigidsearch.fs import iter_documents, iter_sorted_documents
+
+    tmpdir.join('docs', 'foo.html').write('', ensure=True)
+    tmpdir.join('docs', 'foo', 'index.html').write('', ensure=True)
+    base = str(tmpdir.join('docs'))
+    expected = [(u'foo', os.path.join(base, 'foo.html'))]
+    assert list(iter_documents(base)) == expected
+    assert list(iter_sorted_documents(base)) == expected
@@ -10,7 +10,11 @@ def test_basic_index(index_path, project_path):
 
     log = list(index_tree(cfg, index_path=index_path,
                           base_dir=project_path))
-    assert log
+    assert [x.type for x in log] == ['discover', 'index', 'section',
+                                     'index', 'section', 'done']
+    assert log[0].total == 2
+    assert log[-1].stats.indexed == 2
+    assert log[-1].stats.bytes > 0
 
     content_id = 'e324d4f2e1a8a49c4efcc049b296d7b60bce4e7d'
     content_path = os.path.join(index_path, 'cur', 'content')
@@ -27,3 +31,289 @@ def test_basic_index(index_path, project_path):
         'title': u'Hello World',
         'section': 'a'
     }]
+
+    # nothing changed, so an incremental build leaves everything alone
+    log = list(index_tree(cfg, index_path=index_path,
+                          base_dir=project_path))
+    assert [x.type for x in log] == ['discover', 'section', 'section',
+                                     'done']
+
+
+def test_processing_cache(index_path, project_path, monkeypatch):
+    from rigidsearch.search import index_tree, get_index
+    from rigidsearch.cache import ProcessingCache
+    from rigidsearch.htmlprocessor import Processor
+
+    with open(os.path.join(project_path, 'config.json'), 'rb') as f:
+        cfg = json.load(f)
+
+    cache = ProcessingCache(os.path.join(index_path, 'cache'), 1024 * 1024)
+    calls = []
+    parse_document = Processor.parse_document
+
+    def _parse_document(self, document):
+        calls.append(document)
+        return parse_document(self, document)
+    monkeypatch.setattr(Processor, 'parse_document', _parse_document)
+
+    # ver-a and ver-b are identical so the second section hits the cache
+    list(index_tree(cfg, index_path=index_path, base_dir=project_path,
+                    cache=cache))
+    assert len(calls) == 1
+
+    # a from scratch rebuild does not need to parse anything
+    list(index_tree(cfg, index_path=index_path, base_dir=project_path,
+                    cache=cache, copy=False))
+    assert len(calls) == 1
+
+    results = get_index(index_path).search('totally', section='b')
+    assert [x['path'] for x in results['items']] == [u'index']
+
+
+def test_sharded_index(index_path, project_path):
+    from rigidsearch.search import index_tree, get_index, get_shard_path, \
+         get_index_version
+
+    with open(os.path.join(project_path, 'config.json'), 'rb') as f:
+        cfg = json.load(f)
+    cfg['sharded'] = True
+
+    log = list(index_tree(cfg, index_path=index_path,
+                          base_dir=project_path))
+    assert sorted(unicode(x) for x in log if x.type == 'index') == \
+        [u'Indexing index (a)', u'Indexing index (b)']
+
+    for section in 'a', 'b':
+        shard_path = get_shard_path(index_path, section)
+        assert os.path.islink(os.path.join(shard_path, 'cur'))
+        assert get_index_version(index_path, section) == \
+            os.readlink(os.path.join(shard_path, 'cur'))
+
+        index = get_index(index_path, section=section)
+        assert index.section == section
+        assert list(x['section'] for x in index.iter()) == [section]
+        results = index.search('totally', section=section)
+        assert [x['path'] for x in results['items']] == [u'index']
+
+    # the main index does not contain any of the sections
+    assert list(get_index(index_path).iter()) == []
+
+
+def test_stale_shards_are_removed(index_path, project_path, tmpdir):
+    import shutil
+    from rigidsearch.search import index_tree, get_shard_path, \
+         search_sections
+
+    base_dir = str(tmpdir.join('proj'))
+    shutil.copytree(project_path, base_dir)
+    with open(os.path.join(base_dir, 'config.json'), 'rb') as f:
+        cfg = json.load(f)
+
+    # sections that are gone from the config lose their shards
+    cfg['sharded'] = True
+    list(index_tree(cfg, index_path=index_path, base_dir=base_dir))
+    sources = cfg['configurations'][0]['sources']
+    del sources[1:]
+    list(index_tree(cfg, index_path=index_path, base_dir=base_dir))
+    assert os.path.isdir(get_shard_path(index_path, 'a'))
+    assert not os.path.exists(get_shard_path(index_path, 'b'))
+
+    # a build of the main index replaces all shards
+    tmpdir.join('proj', 'ver-a', 'index.html').write(
+        '<title>Changed</title><section class="document">Quite new')
+    cfg['sharded'] = False
+    list(index_tree(cfg, index_path=index_path, base_dir=base_dir))
+    assert not os.path.exists(os.path.join(index_path, 'sections', 'a'))
+    assert search_sections(index_path, 'totally', ['a'])['items'] == []
+    assert [x['path'] for x in search_sections(
+        index_path, 'quite', ['a'])['items']] == [u'index']
+
+
+def test_sharded_build_clears_main_index(index_path, project_path, tmpdir):
+    import shutil
+    from rigidsearch.search import index_tree, search_sections
+
+    base_dir = str(tmpdir.join('proj'))
+    shutil.copytree(project_path, base_dir)
+    with open(os.path.join(base_dir, 'config.json'), 'rb') as f:
+        cfg = json.load(f)
+
+    list(index_tree(cfg, index_path=index_path, base_dir=base_dir))
+    cfg['sharded'] = True
+    list(index_tree(cfg, index_path=index_path, base_dir=base_dir))
+
+    # a removed section is not served from the earlier unsharded build
+    del cfg['configurations'][0]['sources'][1:]
+    list(index_tree(cfg, index_path=index_path, base_dir=base_dir))
+    assert search_sections(index_path, 'totally', ['b'])['items'] == []
+    assert [x['section'] for x in search_sections(
+        index_path, 'totally', None)['items']] == ['a']
+
+
+def test_streaming_index(index_path, project_path, monkeypatch):
+    import shutil
+    from rigidsearch.search import index_tree, get_index, TreeIndexer
+
+    base_dir = os.path.join(index_path, 'src')
+    shutil.copytree(project_path, base_dir)
+    with open(os.path.join(project_path, 'config.json'), 'rb') as f:
+        cfg = json.load(f)
+    cfg['streaming'] = True
+    monkeypatch.setattr(TreeIndexer, 'batch_size', 1)
+
+    def _build():
+        return sorted(unicode(x) for x in index_tree(
+            cfg, index_path=index_path, base_dir=base_dir)
+            if x.type in ('index', 'remove'))
+
+    assert _build() == [u'Indexing index (a)', u'Indexing index (b)']
+    assert _build() == []
+
+    with open(os.path.join(base_dir, 'ver-a', 'new.html'), 'w') as f:
+        f.write('<title>New</title><section class="document">Totally '
+                'new</section>')
+    os.remove(os.path.join(base_dir, 'ver-b', 'index.html'))
+    assert _build() == [u'Indexing new (a)', u'Removing index (b)']
+
+    index = get_index(index_path)
+    assert sorted((x['path'], x['section']) for x in index.iter()) == [
+        (u'index', u'a'), (u'new', u'a')]
+    results = index.search('totally', section='a')
+    assert sorted(x['path'] for x in results['items']) == \
+        [u'index', u'new']
+
+
+def test_progress_reports(index_path, project_path):
+    from rigidsearch.search import index_tree
+    from rigidsearch.progress import iter_reports
+
+    with open(os.path.join(project_path, 'config.json'), 'rb') as f:
+        cfg = json.load(f)
+
+    events = index_tree(cfg, index_path=index_path, base_dir=project_path)
+    reports = list(iter_reports(events, mode='summary', interval=3600))
+    assert [x.type for x in reports] == ['discover', 'section', 'section',
+                                         'done']
+    assert unicode(reports[0]) == u'Found 2 documents'
+    assert reports[0].to_dict()['total'] == 2
+    assert reports[1].to_dict()['stats']['indexed'] == 1
+    assert unicode(reports[-1]) == u'Done!'
+
+
+def test_section_spans(index_path, tmpdir):
+    from rigidsearch.search import index_tree, get_index
+
+    tmpdir.join('docs', 'nested.html').write("""<!doctype html>
+<title>Nested</title>
+<div class="body">
+  <div class="section" id="intro">
+    <p>Intro text about apples.
+    <div class="section" id="details">
+      <p>Details about bananas.
+    </div>
+  </div>
+</div>
+""", ensure=True)
+    cfg = {'configurations': [{
+        'content_selectors': ['div.body'],
+        'content_sections': ['div.section'],
+        'sources': [{'path': 'docs', 'section': 'generic'}],
+    }]}
+    list(index_tree(cfg, index_path=index_path, base_dir=str(tmpdir)))
+
+    # only the page has a content file, sections are spans of it
+    assert len(os.listdir(os.path.join(index_path, 'cur', 'content'))) == 1
+
+    index = get_index(index_path)
+    results = index.search('bananas')
+    assert [x['path'] for x in results['items']] == \
+        [u'nested#details', u'nested']
+    assert results['items'][0]['excerpt'] == \
+        u'Details about <strong class="match term0">bananas</strong>'
+
+    # nested sections are not indexed again for the outer section
+    results = index.search('apples')
+    assert [x['path'] for x in results['items']] == \
+        [u'nested#intro', u'nested']
+    with index.whoosh_index.searcher() as searcher:
+        span = searcher.document(path=u'nested#intro')['span']
+    assert index.get_content(u'nested#intro', u'generic', span=span) == \
+        u'Intro text about apples.\n\nDetails about bananas.'
+
+
+def test_failing_warmup_keeps_build(index_path, project_path):
+    from rigidsearch.search import index_tree, get_index
+
+    with open(os.path.join(project_path, 'config.json'), 'rb') as f:
+        cfg = json.load(f)
+
+    def _warmup(path):
+        raise IOError('warmup failed')
+
+    list(index_tree(cfg, index_path=index_path, base_dir=project_path,
+                    warmup=_warmup))
+    results = get_index(index_path).search('totally', section='a')
+    assert [x['path'] for x in results['items']] == [u'index']
+
+
+def test_plain_excerpts_after_deadline(index_path, project_path,
+                                       monkeypatch):
+    from rigidsearch import search
+
+    with open(os.path.join(project_path, 'config.json'), 'rb') as f:
+        cfg = json.load(f)
+    list(search.index_tree(cfg, index_path=index_path,
+                           base_dir=project_path))
+
+    # the hits are collected in time but the excerpts are not
+    collect_hits = search.collect_hits
+    monkeypatch.setattr(search, 'collect_hits', lambda *args: collect_hits(
+        *args[:-1]))
+    results = search.get_index(index_path).search(
+        'totally', section='a', time_limit=0)
+    assert results['truncated']
+    assert results['items'][0]['excerpt'] == \
+        u'Yo, this should totally be indexed.'
+
+
+def test_own_texts_of_nested_sections():
+    from rigidsearch.search import get_own_texts
+
+    text = u'a b c d e f'
+    # a [b [c] d] [e] f
+    spans = [(0, 11), (2, 7), (4, 5), (8, 9), (4, 5)]
+    assert get_own_texts(text, spans) == {
+        (0, 11): u'a\nf',
+        (2, 7): u'b\nd',
+        (4, 5): u'c',
+        (8, 9): u'e',
+    }
+
+
+def test_federated_pages_with_duplicates(index_path, tmpdir):
+    from rigidsearch.search import index_tree, search_sections
+
+    for section in 'a', 'b':
+        for idx in xrange(100):
+            tmpdir.join(section, 'page%d.html' % idx).write(
+                '<title>Page</title><section class="document">Totally '
+                'the same</section>', ensure=True)
+    cfg = {'configurations': [{
+        'content_selectors': ['section.document'],
+        'sources': [{'path': 'a', 'section': 'a'},
+                    {'path': 'b', 'section': 'b'}],
+    }]}
+
+    # the duplicates past the first page must not inflate the page count,
+    # both in a single index and across shards
+    for sharded in False, True:
+        cfg['sharded'] = sharded
+        list(index_tree(cfg, index_path=index_path, base_dir=str(tmpdir)))
+        seen = set()
+        for page in xrange(1, 7):
+            results = search_sections(index_path, 'totally', ['a', 'b'],
+                                      page=page, per_page=20)
+            assert results['pages'] == 5
+            assert len(results['items']) == (page <= 5 and 20 or 0)
+            seen.update(x['path'] for x in results['items'])
+        assert len(seen) == 100
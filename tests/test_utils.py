@@ -0,0 +1,19 @@
+def test_normalize_text():
+    from rigidsearch.utils import normalize_text
+
+    assert normalize_text(u'\n\n  foo \t bar\n  baz \n\n \n qux\n') == \
+        u'foo bar\nbaz\n\nqux'
+    assert normalize_text(u'a\r\nb') == u'a\nb'
+    assert normalize_text(u'a \xa0b') == u'a \xa0b'
+
+
+def test_normalize_text_spans():
+    from rigidsearch.utils import normalize_text, normalize_text_spans
+
+    text = u'\n\n  foo \t bar\n  baz \n\n \n qux\n'
+    spans = [(text.index(u'bar'), text.index(u'qux') + 3),
+             (text.index(u'baz'), text.index(u'baz') + 3)]
+    rv, spans = normalize_text_spans(text, spans)
+    assert rv == normalize_text(text)
+    assert [rv[start:end] for start, end in spans] == \
+        [u'bar\nbaz\n\nqux', u'baz']